@@ -0,0 +1,217 @@
+"""Benchmark the database import and report build on synthetic NEM12 data
+
+Each case runs in a fresh process so its peak RSS is not inflated by the
+cases before it. Compare against the stored baseline with:
+
+    python benchmarks/bench.py
+
+and store new results as the baseline with `--save`.
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import time
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Annotated
+
+import typer
+
+BASELINE_FILE = Path(__file__).parent / "baseline.json"
+WORK_DIR = Path("bench_data")
+CASES: dict[str, Callable] = {}
+app = typer.Typer()
+
+
+def case(func: Callable) -> Callable:
+    CASES[func.__name__] = func
+    return func
+
+
+def first_nmi() -> str:
+    from nemreport.model import get_db
+
+    return get_db().execute("SELECT MIN(nmi) FROM nmi_extent").fetchone()[0]
+
+
+@case
+def update_db_full(data_dir: Path, output_dir: Path):
+    from nemreport.prepare_db import update_nem_database
+
+    return lambda: update_nem_database(data_dir, full=True)
+
+
+@case
+def update_db_unchanged(data_dir: Path, output_dir: Path):
+    from nemreport.prepare_db import update_nem_database
+
+    return lambda: update_nem_database(data_dir)
+
+
+@case
+def load_nmi_data_cold(data_dir: Path, output_dir: Path):
+    from nemreport.model import get_interval_arrays
+
+    nmi = first_nmi()
+    return lambda: get_interval_arrays(nmi)
+
+
+@case
+def load_nmi_data_cached(data_dir: Path, output_dir: Path):
+    from nemreport.model import load_nmi_data
+
+    nmi = first_nmi()
+    load_nmi_data(nmi)  # Write the cache file
+    return lambda: load_nmi_data(nmi)
+
+
+def stage_case(name: str, *args):
+    """Time one of the build_* stages of a report"""
+
+    def setup(data_dir: Path, output_dir: Path):
+        from nemreport import report
+        from nemreport.model import load_nmi_data, load_summaries
+
+        nmi = first_nmi()
+        nmi_data = load_nmi_data(nmi)
+        func = getattr(report, name)
+        target = nmi_data
+        if name == "build_month_table":
+            target = load_summaries([nmi])[nmi]
+        return lambda: func(target, *args)
+
+    setup.__name__ = name
+    return case(setup)
+
+
+for stage in [
+    "build_calendar_charts",
+    "build_month_table",
+    "build_daily_plot",
+    "build_usage_heatmap",
+    "build_day_profile_plot",
+    "build_days_profiles_plot",
+    "build_load_duration_curve",
+]:
+    stage_case(stage)
+
+
+@case
+def load_summaries(data_dir: Path, output_dir: Path):
+    from nemreport.model import load_summaries
+
+    return load_summaries
+
+
+@case
+def build_report(data_dir: Path, output_dir: Path):
+    from nemreport.report import build_report
+
+    nmi = first_nmi()
+    return lambda: build_report(nmi)
+
+
+@case
+def build_reports(data_dir: Path, output_dir: Path):
+    from nemreport.report import build_reports
+
+    return lambda: build_reports(force=True)
+
+
+def run_case(name: str, data_dir: Path, output_dir: Path, repeat: int) -> dict:
+    """Set up and time a case, returning the fastest of its runs"""
+    from nemreport.prepare_db import update_nem_database
+    from nemreport.profiling import peak_rss_mb
+    from nemreport.report import configure
+
+    configure(data_dir, output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    update_nem_database(data_dir)
+    func = CASES[name](data_dir, output_dir)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"seconds": round(min(times), 4), "peak_rss_mb": round(peak_rss_mb(), 1)}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Print the results against the baseline and list any regressions"""
+    slower = []
+    typer.echo(f"{'case':<28}{'seconds':>10}{'baseline':>10}{'change':>9}{'RSS MB':>9}")
+    for name, res in results.items():
+        base = baseline.get(name, {}).get("seconds")
+        change = ""
+        if base:
+            ratio = res["seconds"] / base - 1
+            change = f"{ratio:+.0%}"
+            if ratio > tolerance:
+                slower.append(name)
+        base_txt = f"{base:.4f}" if base else "-"
+        typer.echo(
+            f"{name:<28}{res['seconds']:>10.4f}{base_txt:>10}"
+            f"{change:>9}{res['peak_rss_mb']:>9.1f}"
+        )
+    return slower
+
+
+@app.command()
+def main(
+    nmis: int = typer.Option(2, "--nmis", min=1, help="Number of synthetic NMIs"),
+    years: float = typer.Option(1.0, "--years", help="Years of history per NMI"),
+    interval: int = typer.Option(30, "--interval", help="Interval length (minutes)"),
+    gaps: float = typer.Option(0.02, "--gaps", help="Fraction of days with no data"),
+    repeat: int = typer.Option(3, "--repeat", min=1, help="Runs per case"),
+    only: Annotated[
+        list[str] | None, typer.Option("--only", help="Only run these cases")
+    ] = None,
+    work_dir: Annotated[
+        Path, typer.Option("--work-dir", help="Folder for the generated data")
+    ] = WORK_DIR,
+    save: bool = typer.Option(False, "--save", help="Store results as the baseline"),
+    tolerance: float = typer.Option(
+        0.25, "--tolerance", help="Allowed slowdown before a case fails"
+    ),
+) -> None:
+    from nemreport.synthetic import generate_nem12_files
+
+    params = {"nmis": nmis, "years": years, "interval": interval, "gaps": gaps}
+    data_dir, output_dir = work_dir / "data", work_dir / "output"
+    shutil.rmtree(work_dir, ignore_errors=True)
+    generate_nem12_files(
+        data_dir, num_nmis=nmis, years=years, interval=interval, gap_fraction=gaps
+    )
+    os.environ["BROWSER"] = "true"  # Stop build_reports opening a browser
+
+    results = {}
+    ctx = multiprocessing.get_context("spawn")
+    for name in only or CASES:
+        with ProcessPoolExecutor(1, mp_context=ctx) as pool:
+            results[name] = pool.submit(
+                run_case, name, data_dir, output_dir, repeat
+            ).result()
+
+    baseline = {}
+    if BASELINE_FILE.exists():
+        baseline = json.loads(BASELINE_FILE.read_text())
+        if baseline["params"] != params:
+            typer.echo(f"Baseline was run with {baseline['params']}, not comparing")
+            baseline = {}
+    slower = compare(results, baseline.get("results", {}), tolerance)
+
+    if save:
+        stored = {"params": params, "machine": platform.platform(), "results": results}
+        BASELINE_FILE.write_text(json.dumps(stored, indent=2) + "\n")
+        typer.echo(f"Saved baseline to {BASELINE_FILE}")
+    elif slower:
+        typer.echo(f"Slower than baseline: {', '.join(slower)}")
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
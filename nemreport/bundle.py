@@ -0,0 +1,74 @@
+"""Bundle the scripts and styles the reports need, and precompress them
+
+With the bundle the output folder can be served without internet access, and
+web servers that support it (e.g. nginx gzip_static/brotli_static) can send
+the precompressed files as is.
+"""
+
+import gzip
+import logging
+from pathlib import Path
+from urllib.request import urlopen
+
+from plotly.offline import get_plotlyjs, get_plotlyjs_version
+
+try:
+    import brotli
+except ImportError:  # Optional, only .gz files are written without it
+    brotli = None
+
+log = logging.getLogger(__name__)
+ASSET_DIR = "assets"
+PLOTLY_JS = f"{ASSET_DIR}/plotly-{get_plotlyjs_version()}.min.js"
+STYLESHEET = f"{ASSET_DIR}/water.css"
+STYLESHEET_URL = "https://cdn.jsdelivr.net/npm/water.css@2/out/water.css"
+COMPRESS_PATTERNS = ["*.html", f"{ASSET_DIR}/*.js", f"{ASSET_DIR}/*.css"]
+
+
+def download(url: str) -> bytes:
+    with urlopen(url, timeout=30) as resp:
+        return resp.read()
+
+
+def write_assets(output_dir: Path) -> None:
+    """Write plotly.js and the stylesheet once, for every page to share
+
+    The stylesheet is the same water.css that online pages link to, downloaded
+    the first time a bundle is made so offline pages look the same.
+    """
+    (output_dir / ASSET_DIR).mkdir(parents=True, exist_ok=True)
+    plotly_path = output_dir / PLOTLY_JS
+    if not plotly_path.exists():
+        plotly_path.write_text(get_plotlyjs(), encoding="utf-8")
+        log.info("Created %s", plotly_path)
+    css_path = output_dir / STYLESHEET
+    if not css_path.exists():
+        try:
+            css_path.write_bytes(download(STYLESHEET_URL))
+            log.info("Created %s", css_path)
+        except OSError as e:
+            log.warning("Unable to download %s, unstyled: %s", STYLESHEET_URL, e)
+
+
+def is_stale(source: Path, target: Path) -> bool:
+    return not target.exists() or target.stat().st_mtime < source.stat().st_mtime
+
+
+def precompress(output_dir: Path) -> list[Path]:
+    """Write .gz (and .br) copies of the pages and assets that changed"""
+    written = []
+    for pattern in COMPRESS_PATTERNS:
+        for file_path in output_dir.glob(pattern):
+            gz_path = file_path.with_name(file_path.name + ".gz")
+            br_path = file_path.with_name(file_path.name + ".br")
+            data = None
+            if is_stale(file_path, gz_path):
+                data = file_path.read_bytes()
+                gz_path.write_bytes(gzip.compress(data, compresslevel=9, mtime=0))
+                written.append(gz_path)
+            if brotli is not None and is_stale(file_path, br_path):
+                data = data or file_path.read_bytes()
+                br_path.write_bytes(brotli.compress(data))
+                written.append(br_path)
+    log.info("Precompressed %s files", len(written))
+    return written
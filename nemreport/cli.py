@@ -1,16 +1,19 @@
 import logging
 from pathlib import Path
+from typing import Annotated
 
 import typer
 
-from .prepare_db import update_nem_database
-from .report import build_reports
 from .version import __version__
 
+# Commands import the database and report modules when they run, as they pull
+# in pandas, polars, plotly and matplotlib and would slow down every command.
+
 LOG_FORMAT = "%(asctime)s %(levelname)-8s %(message)s"
 logging.basicConfig(level="INFO", format=LOG_FORMAT)
 app = typer.Typer()
-DEFAULT_DIR = Path(".")
+DEFAULT_DATA_DIR = Path("data")
+DEFAULT_OUTPUT_DIR = Path("output")
 
 
 def version_callback(value: bool):
@@ -21,22 +24,274 @@ def version_callback(value: bool):
 
 @app.callback()
 def callback(
+    ctx: typer.Context,
     version: bool = typer.Option(False, "--version", callback=version_callback),
+    data_dir: Annotated[
+        Path, typer.Option("--data-dir", help="Folder with the NEM files and database")
+    ] = DEFAULT_DATA_DIR,
+    output_dir: Annotated[
+        Path, typer.Option("--output-dir", help="Folder to write the reports to")
+    ] = DEFAULT_OUTPUT_DIR,
 ) -> None:
     """nemreport
 
     Generate energy report from NEM meter data files
     """
-    pass
+    ctx.obj = {"data_dir": data_dir, "output_dir": output_dir}
 
 
 @app.command()
-def update_db() -> None:
-    fp = update_nem_database()
+def update_db(
+    ctx: typer.Context,
+    full: bool = typer.Option(
+        False, "--full", help="Rebuild the database from every file"
+    ),
+    jobs: int = typer.Option(
+        1, "--jobs", "-j", min=1, help="Number of files to parse in parallel"
+    ),
+) -> None:
+    from .prepare_db import update_nem_database
+
+    fp = update_nem_database(ctx.obj["data_dir"], full=full, jobs=jobs)
     typer.echo(f"Updated {fp}")
 
 
 @app.command()
-def build() -> None:
-    fp = build_reports()
+def check_db(ctx: typer.Context) -> None:
+    from sqlite_utils import Database
+
+    from .prepare_db import DB_FILE, missing_indexes
+
+    missing = missing_indexes(Database(ctx.obj["data_dir"] / DB_FILE))
+    for name in missing:
+        typer.echo(f"Missing {name}")
+    if missing:
+        typer.echo("Run update-db to create them")
+        raise typer.Exit(code=1)
+    typer.echo("All expected indexes exist")
+
+
+@app.command()
+def query(
+    ctx: typer.Context,
+    nmi: str = typer.Argument(..., help="NMI to query"),
+    resolution: str = typer.Option(
+        "day", "--resolution", "-r", help="30min, hour, day, week, month or year"
+    ),
+    start: str | None = typer.Option(None, "--start", help="First period to include"),
+    end: str | None = typer.Option(None, "--end", help="Period to stop before"),
+    fmt: str = typer.Option("csv", "--format", help="Output as csv or json"),
+) -> None:
+    import csv
+    import json
+    import sys
+
+    from .model import connect, query_usage, set_data_dir
+    from .prepare_db import missing_indexes
+
+    if fmt not in ("csv", "json"):
+        raise typer.BadParameter("Must be one of csv, json")
+    set_data_dir(ctx.obj["data_dir"])
+    if missing_indexes(connect()):
+        typer.echo("Run update-db to create the rollup tables", err=True)
+        raise typer.Exit(code=1)
+    try:
+        rows = query_usage(nmi, resolution, start, end)
+    except ValueError as e:
+        raise typer.BadParameter(str(e)) from e
+    if fmt == "json":
+        typer.echo(json.dumps(rows, indent=2))
+    elif rows:
+        writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+@app.command()
+def tariffs(
+    ctx: typer.Context,
+    file: Annotated[
+        Path | None,
+        typer.Option("--file", help="Tariff definitions (default: data folder)"),
+    ] = None,
+    top: int = typer.Option(5, "--top", min=1, help="Tariffs to list for each NMI"),
+    fmt: str = typer.Option("table", "--format", help="Output as table, csv or json"),
+) -> None:
+    import csv
+    import json
+    import sys
+
+    from .model import connect, get_nmi_list, load_nmi_data, set_data_dir
+    from .prepare_db import missing_indexes
+    from .tariffs import TariffEngine, UsageGrid, find_tariff_file, load_tariffs
+
+    if fmt not in ("table", "csv", "json"):
+        raise typer.BadParameter("Must be one of table, csv, json")
+    data_dir = ctx.obj["data_dir"]
+    file = file or find_tariff_file(data_dir)
+    if file is None:
+        typer.echo(f"No tariffs.json or tariffs.yaml in {data_dir}", err=True)
+        raise typer.Exit(code=1)
+    try:
+        engine = TariffEngine(load_tariffs(file))
+    except (OSError, ValueError, ImportError) as e:
+        raise typer.BadParameter(str(e), param_hint="--file") from e
+    set_data_dir(data_dir)
+    if missing_indexes(connect()):
+        typer.echo("Run update-db to create the database", err=True)
+        raise typer.Exit(code=1)
+
+    rows = []
+    for nmi in get_nmi_list():
+        rows += engine.rank(UsageGrid.from_nmi_data(load_nmi_data(nmi)))[:top]
+    if fmt == "json":
+        typer.echo(json.dumps(rows, indent=2))
+    elif fmt == "csv" and rows:
+        writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    elif fmt == "table":
+        saving = f"saving vs {engine.baseline[:20]}"
+        width = len(saving) + 2
+        typer.echo(
+            f"{'NMI':<12}{'#':>4}  {'tariff':<30}{'per year':>12}{saving:>{width}}"
+        )
+        for x in rows:
+            typer.echo(
+                f"{x['nmi']:<12}{x['rank']:>4}  {x['tariff'][:29]:<30}"
+                f"{x['annual']:>12.2f}{x['saving']:>{width}.2f}"
+            )
+
+
+@app.command()
+def generate(
+    ctx: typer.Context,
+    nmis: int = typer.Option(2, "--nmis", min=1, help="Number of NMIs"),
+    years: float = typer.Option(1.0, "--years", min=0.01, help="Years of history"),
+    interval: int = typer.Option(30, "--interval", help="Interval length (minutes)"),
+    export: bool = typer.Option(True, "--export/--no-export", help="Add B1 export"),
+    gaps: float = typer.Option(
+        0.0, "--gaps", min=0.0, max=0.9, help="Fraction of days with no data"
+    ),
+    seed: int = typer.Option(0, "--seed", help="Random seed"),
+) -> None:
+    from .synthetic import INTERVALS, generate_nem12_files
+
+    if interval not in INTERVALS:
+        raise typer.BadParameter(f"Must be one of {', '.join(map(str, INTERVALS))}")
+    files = generate_nem12_files(
+        ctx.obj["data_dir"],
+        num_nmis=nmis,
+        years=years,
+        interval=interval,
+        export=export,
+        gap_fraction=gaps,
+        seed=seed,
+    )
+    typer.echo(f"Created {len(files)} synthetic NEM12 files")
+
+
+@app.command()
+def build(
+    ctx: typer.Context,
+    jobs: int = typer.Option(
+        1, "--jobs", "-j", min=1, help="Number of reports to build in parallel"
+    ),
+    force: bool = typer.Option(
+        False, "--force", help="Rebuild reports even if their inputs are unchanged"
+    ),
+    only: Annotated[
+        list[str] | None, typer.Option("--only", help="Only rebuild this NMI")
+    ] = None,
+    profiles: str = typer.Option(
+        "lines", "--profiles", help="Draw daily profiles as lines, bands or both"
+    ),
+    compare_years: bool = typer.Option(
+        False,
+        "--compare-years",
+        help="Compare the load duration curve with each prior year",
+    ),
+    keep_fragments: bool = typer.Option(
+        False, "--keep-fragments", help="Also save each chart as its own file"
+    ),
+    calendar: str = typer.Option(
+        "calplot", "--calendar", help="Draw usage calendars with calplot or plotly"
+    ),
+    max_points: int = typer.Option(
+        1000,
+        "--max-points",
+        min=10,
+        help="Most bars or heatmap rows per chart before resampling to weeks",
+    ),
+    profile: bool = typer.Option(
+        False, "--profile", help="Save the time and memory of each build stage"
+    ),
+    cprofile: str | None = typer.Option(
+        None, "--cprofile", help="Build only this NMI under cProfile"
+    ),
+    stages: str | None = typer.Option(
+        None,
+        "--stages",
+        help="Only rerun these comma separated stages, e.g. heatmap,ldc",
+    ),
+    threads: int = typer.Option(
+        4, "--threads", min=1, help="Stages of a report to run at once"
+    ),
+    offline: bool = typer.Option(
+        False, "--offline", help="Bundle plotly.js and styles instead of using CDNs"
+    ),
+) -> None:
+    from .report import (
+        CALENDAR_RENDERERS,
+        OUTPUT_STAGES,
+        PROFILES_MODES,
+        build_reports,
+        configure,
+    )
+
+    if profiles not in PROFILES_MODES:
+        raise typer.BadParameter(f"Must be one of {', '.join(PROFILES_MODES)}")
+    if calendar not in CALENDAR_RENDERERS:
+        raise typer.BadParameter(f"Must be one of {', '.join(CALENDAR_RENDERERS)}")
+    stage_list = stages.split(",") if stages else None
+    if stage_list and set(stage_list) - set(OUTPUT_STAGES):
+        msg = f"Stages must be from {', '.join(OUTPUT_STAGES)}"
+        raise typer.BadParameter(msg, param_hint="--stages")
+    configure(ctx.obj["data_dir"], ctx.obj["output_dir"], offline)
+    fp = build_reports(
+        jobs=jobs,
+        force=force,
+        only=only,
+        profiles_mode=profiles,
+        compare_years=compare_years,
+        keep_fragments=keep_fragments,
+        calendar=calendar,
+        max_points=max_points,
+        profile=profile,
+        cprofile=cprofile,
+        stages=stage_list,
+        threads=threads,
+    )
     typer.echo(f"Created {fp}")
+
+
+@app.command()
+def serve(
+    ctx: typer.Context,
+    host: str = typer.Option("127.0.0.1", "--host", help="Address to listen on"),
+    port: int = typer.Option(8000, "--port", help="Port to listen on"),
+    watch: float = typer.Option(
+        10.0, "--watch", min=0, help="Seconds between checks for new files (0 = off)"
+    ),
+    open_browser: bool = typer.Option(
+        False, "--open", help="Open the reports in a browser"
+    ),
+    offline: bool = typer.Option(
+        False, "--offline", help="Bundle plotly.js and styles instead of using CDNs"
+    ),
+) -> None:
+    from .report import configure
+    from .server import serve
+
+    configure(ctx.obj["data_dir"], ctx.obj["output_dir"], offline)
+    serve(host, port, watch_interval=watch, open_browser=open_browser)
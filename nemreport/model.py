@@ -1,171 +1,438 @@
-from collections import defaultdict
-from collections.abc import Generator
-from datetime import datetime
+import hashlib
+import json
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from functools import cached_property
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import polars as pl
 from dateutil.parser import isoparse
-from nemreader.output_db import get_nmi_channels, get_nmi_readings
-from pydantic import BaseModel
 from sqlite_utils import Database
 
-data_dir = Path("data/")
-data_dir.mkdir(exist_ok=True)
-DB_PATH = data_dir / "nemdata.db"
-db = Database(DB_PATH)
+from .prepare_db import DB_FILE, DEFAULT_DIR, ROLLUP_COLUMNS, SET_INTERVAL
+from .profiling import timed
 
+data_dir = DEFAULT_DIR
+db: Database | None = None
 
-class EnergyReading(BaseModel):
-    start: datetime
-    value: float
-
-
-def get_date_range(nmi: str) -> tuple[datetime, datetime]:
-    sql = """select MIN(first_interval) start, MAX(last_interval) end
-            from nmi_summary where nmi = :nmi
-            """
-    res = db.query(sql, {"nmi": nmi})
-    res = list(res)
-    row = res[0]
-    start = isoparse(row["start"])
-    end = isoparse(row["end"])
-    return start, end
-
-
-def get_usage_df(nmi: str) -> pd.DataFrame:
-    channels = get_nmi_channels(DB_PATH, nmi)
-    imp_values = defaultdict(int)
-    exp_values = defaultdict(int)
-    for ch in channels:
-        feed_in = ch in ["B1"]
-        for read in get_nmi_readings(DB_PATH, nmi, ch):
-            dt = read.start
-            if feed_in:
-                exp_values[dt] += read.value
-            else:
-                imp_values[dt] += read.value
-
-    df = pd.DataFrame(
-        data={"consumption": [imp_values[x] for x in imp_values]},
-        index=imp_values.keys(),
+
+def set_data_dir(path: Path) -> None:
+    """Read the database and cache from a different folder"""
+    global data_dir, db
+    data_dir = Path(path)
+    db = None
+
+
+def connect(db_path: Path | None = None) -> Database:
+    """Open a new connection to the database for the current process
+
+    SQLite connections must not be shared between processes, so report
+    workers call this before running any queries.
+    """
+    global db
+    db = Database(db_path or data_dir / DB_FILE)
+    return db
+
+
+def get_db() -> Database:
+    """Get the database connection, opening it on first use"""
+    if db is None:
+        return connect()
+    return db
+
+
+SEASONS = ["SUMMER", "AUTUMN", "WINTER", "SPRING"]
+# Season for each calendar month, indexed from January
+MONTH_SEASONS = np.array(
+    ["SUMMER"] * 2 + ["AUTUMN"] * 3 + ["WINTER"] * 3 + ["SPRING"] * 3 + ["SUMMER"]
+)
+# Query resolutions: (SQL for the period of a rollup t_start, tables to read)
+RESOLUTIONS = {
+    "30min": ("t_start", ["rollup_30min"]),
+    "hour": ("substr(t_start, 1, 13) || ':00:00'", ["rollup_hour", "rollup_30min"]),
+    "day": ("substr(t_start, 1, 10)", ["rollup_day", "rollup_hour", "rollup_30min"]),
+    "week": (
+        "date(substr(t_start, 1, 10), '-6 days', 'weekday 1')",
+        ["rollup_day", "rollup_hour", "rollup_30min"],
+    ),
+    "month": (
+        "substr(t_start, 1, 7)",
+        ["rollup_month", "rollup_day", "rollup_hour", "rollup_30min"],
+    ),
+    "year": (
+        "substr(t_start, 1, 4)",
+        ["rollup_month", "rollup_day", "rollup_hour", "rollup_30min"],
+    ),
+}
+# "HH:MM" label for each minute of the day
+TIME_LABELS = np.array([f"{m // 60:02d}:{m % 60:02d}" for m in range(24 * 60)])
+
+
+def align_bound(value: str | None, table: str) -> str | None:
+    """Format a period bound as a t_start key, if it falls on a table period"""
+    if value is None:
+        return None
+    dt = isoparse(value)
+    if table == "rollup_month" and dt == dt.replace(day=1, hour=0, minute=0, second=0):
+        return dt.strftime("%Y-%m")
+    if table == "rollup_day" and dt == dt.replace(hour=0, minute=0, second=0):
+        return dt.strftime("%Y-%m-%d")
+    if table == "rollup_hour" and dt == dt.replace(minute=0, second=0):
+        return dt.strftime("%Y-%m-%dT%H:%M:%S")
+    if table == "rollup_30min" and dt.minute in (0, 30) and dt.second == 0:
+        return dt.strftime("%Y-%m-%dT%H:%M:%S")
+    return None
+
+
+def choose_rollup(
+    resolution: str, start: str | None = None, end: str | None = None
+) -> tuple[str, str | None, str | None]:
+    """Pick the coarsest rollup table that can answer a query
+
+    The table's periods must nest within the requested resolution and the
+    start and end must fall on its period boundaries.
+    """
+    if resolution not in RESOLUTIONS:
+        msg = f"Resolution must be one of {', '.join(RESOLUTIONS)}"
+        raise ValueError(msg)
+    for table in RESOLUTIONS[resolution][1]:
+        keys = align_bound(start, table), align_bound(end, table)
+        if (start is None or keys[0]) and (end is None or keys[1]):
+            return table, *keys
+    msg = "Start and end must fall on a 30 minute boundary"
+    raise ValueError(msg)
+
+
+@timed
+def query_usage(
+    nmi: str, resolution: str, start: str | None = None, end: str | None = None
+) -> list[dict]:
+    """Energy for each period from `start` (inclusive) to `end` (exclusive)"""
+    table, start_key, end_key = choose_rollup(resolution, start, end)
+    period, tables = RESOLUTIONS[resolution]
+    if table == tables[0] and resolution not in ("week", "year"):
+        # The table already has one row per period
+        values = ", ".join(ROLLUP_COLUMNS)
+        sql = f"SELECT t_start AS period, {values} FROM {table} WHERE nmi = :nmi"
+        group_by = " ORDER BY t_start"
+    else:
+        sums = ", ".join(f"ROUND(SUM({x}), 3) AS {x}" for x in ROLLUP_COLUMNS)
+        sql = f"SELECT {period} AS period, {sums} FROM {table} WHERE nmi = :nmi"
+        group_by = " GROUP BY 1 ORDER BY 1"
+    if start_key:
+        sql += " AND t_start >= :start"
+    if end_key:
+        sql += " AND t_start < :end"
+    sql += group_by
+    params = {"nmi": nmi, "start": start_key, "end": end_key}
+    return list(get_db().query(sql, params))
+
+
+def get_nmi_list() -> list[str]:
+    """NMIs with readings in the database"""
+    sql = "SELECT nmi FROM nmi_extent ORDER BY nmi"
+    return [row[0] for row in get_db().execute(sql)]
+
+
+@timed
+def get_interval_arrays(nmi: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Read the interval start times, import and export kWh for an NMI
+
+    Readings are fetched in one query into typed arrays and summed across
+    channels, with channels starting with B counted as export.
+    """
+    sql = """SELECT t_start, substr(channel, 1, 1) = 'B', value
+    FROM readings WHERE nmi = :nmi"""
+    rows = get_db().execute(sql, {"nmi": nmi}).fetchall()
+    dtype = [("t_start", "U19"), ("feed_in", "?"), ("value", "f8")]
+    reads = np.fromiter(rows, dtype=dtype, count=len(rows))
+    t_start, idx = np.unique(
+        reads["t_start"].astype("datetime64[s]"), return_inverse=True
     )
-    ser = pd.Series(data=[-exp_values[x] for x in exp_values], index=exp_values.keys())
-    df.loc[:, "export"] = ser
-    return df.fillna(0)
-
-
-def get_season_data(nmi: str):
-    sql = "SELECT *"
-    sql += "FROM latest_year_seasons where nmi = :nmi"
-    res = db.query(sql, {"nmi": nmi})
-    return list(res)
-
-
-def get_annual_data(nmi: str):
-    sql = "SELECT *"
-    sql += "FROM latest_year where nmi = :nmi"
-    res = db.query(sql, {"nmi": nmi})
-    res = list(res)
-    return res[0]
-
-
-def get_day_data(
-    nmi: str,
-) -> Generator[tuple[str, float, float], None, None]:
-    sql = "SELECT day, imp, exp "
-    sql += "FROM daily_reads WHERE nmi = :nmi"
-    for row in db.query(sql, {"nmi": nmi}):
-        dt = datetime.strptime(row["day"], "%Y-%m-%d")
-        row = (
-            dt,
-            row["imp"],
-            row["exp"],
-        )
-        yield row
+    values = reads["value"]
+    feed_in = reads["feed_in"]
+    imp = np.bincount(
+        idx, weights=np.where(feed_in, 0.0, values), minlength=len(t_start)
+    )
+    exp = np.bincount(
+        idx, weights=np.where(feed_in, values, 0.0), minlength=len(t_start)
+    )
+    return t_start, imp, exp
 
 
-def get_day_profile(nmi: str):
-    db.create_view(
-        "combined_readings",
-        """
-    SELECT nmi, t_start, t_end, 
-    SUM(CASE WHEN substr(channel,1,1) = 'B' THEN -1 * value ELSE value END) as value
-    FROM readings
-    GROUP BY nmi, t_start, t_end
-    ORDER BY 1, 2
-    """,
-        replace=True,
+@timed
+def get_nmi_fingerprint(nmi: str) -> str:
+    """Hash the extent, number and total of the readings of an NMI
+
+    The total changes when a revised file replaces reads without adding any.
+    """
+    sql = """SELECT first_interval, last_interval, num_readings, total_value
+    FROM nmi_extent WHERE nmi = :nmi"""
+    row = get_db().execute(sql, {"nmi": nmi}).fetchone()
+    return hashlib.sha256(repr(row).encode()).hexdigest()[:16]
+
+
+@timed
+def get_cached_interval_arrays(
+    nmi: str, cache_dir: Path | None = None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Read the interval arrays for an NMI from its Arrow IPC cache file
+
+    The file is named by the NMI's fingerprint, so it is only rewritten from
+    the database once that NMI's readings change.
+    """
+    cache_dir = cache_dir or data_dir / "cache"
+    file_path = cache_dir / f"{nmi}_{get_nmi_fingerprint(nmi)}.arrow"
+    if file_path.exists():
+        df = pl.read_ipc(file_path)  # Memory mapped as it is uncompressed
+        t_start = df["t_start"].to_numpy().astype("datetime64[s]")
+        return t_start, df["imp"].to_numpy(), df["exp"].to_numpy()
+
+    t_start, imp, exp = get_interval_arrays(nmi)
+    cache_dir.mkdir(exist_ok=True)
+    for old_path in cache_dir.glob(f"{nmi}_*.arrow"):
+        old_path.unlink()
+    df = pl.DataFrame(
+        {"t_start": t_start.astype("datetime64[ms]"), "imp": imp, "exp": exp}
+    )
+    tmp_path = file_path.with_suffix(".tmp")
+    df.write_ipc(tmp_path, compression="uncompressed")
+    tmp_path.replace(file_path)
+    return t_start, imp, exp
+
+
+def query_frame(sql: str, nmis: list[str] | None = None) -> pl.DataFrame:
+    """Run a summary query for some (or all) NMIs into a DataFrame"""
+    params = {}
+    if nmis is not None:
+        sql += " WHERE nmi IN (SELECT value FROM json_each(:nmis))"
+        params["nmis"] = json.dumps(nmis)
+    cursor = get_db().execute(sql, params)
+    columns = [x[0] for x in cursor.description]
+    return pl.DataFrame(
+        cursor.fetchall(), schema=columns, orient="row", infer_schema_length=None
     )
-    sql = """
-    WITH reads AS (
-    SELECT
-        strftime('%H:%M', cr.t_start) AS time,
-        cr.nmi, cr.t_start, cr.t_end, cr.value
-    FROM combined_readings cr
-    LEFT JOIN (SELECT NMI, MAX(last_interval) as last_interval FROM nmi_summary
-    GROUP BY NMI) li ON li.nmi = cr.nmi
-    WHERE cr.t_start >= DATETIME(li.last_interval, '-366 days')
-    AND cr.nmi = :nmi
+
+
+def flag_incomplete_months(df: pl.DataFrame) -> pl.DataFrame:
+    """Mark months with fewer days of data than the month has with a *"""
+    if df.is_empty():
+        return df
+    first_day = (pl.col("month") + "-01").str.to_date("%Y-%m-%d")
+    incomplete = pl.col("num_days") < first_day.dt.month_end().dt.day()
+    return df.with_columns(
+        pl.when(incomplete)
+        .then(pl.col("month") + "*")
+        .otherwise(pl.col("month"))
+        .alias("month")
     )
-    SELECT time, AVG(value)*12 as value
-    FROM reads
-    GROUP BY time
+
+
+@dataclass
+class NMISummary:
+    """The summary tables of one NMI, as used by its report"""
+
+    nmi: str
+    start: datetime
+    end: datetime
+    annual: dict
+    seasons: pl.DataFrame
+    months: pl.DataFrame
+
+
+@timed
+def load_summaries(nmis: list[str] | None = None) -> dict[str, NMISummary]:
+    """Load the summaries of many NMIs with one query per table
+
+    Each table is read for all the NMIs at once and then split by NMI, rather
+    than running a handful of small queries for every NMI.
     """
-    rows = list(db.query(sql, {"nmi": nmi}))
-    data = {
-        "time": [x["time"] for x in rows],
-        "Avg kW": [x["value"] for x in rows],
+    extents = query_frame(
+        "SELECT nmi, first_interval, last_interval FROM nmi_extent", nmis
+    )
+    annual = query_frame("SELECT * FROM latest_year", nmis)
+    seasons = query_frame("SELECT * FROM latest_year_seasons", nmis)
+    months = flag_incomplete_months(
+        query_frame("SELECT * FROM monthly_reads", nmis).sort("nmi", "month")
+    )
+
+    annual_rows = {x["nmi"]: x for x in annual.to_dicts()}
+    season_parts = seasons.partition_by("nmi", as_dict=True, include_key=False)
+    month_parts = months.partition_by("nmi", as_dict=True, include_key=False)
+    no_seasons, no_months = seasons.clear().drop("nmi"), months.clear().drop("nmi")
+    return {
+        nmi: NMISummary(
+            nmi=nmi,
+            start=isoparse(first),
+            end=isoparse(last),
+            annual=annual_rows.get(nmi, {}),
+            seasons=season_parts.get((nmi,), no_seasons),
+            months=month_parts.get((nmi,), no_months),
+        )
+        for nmi, first, last in extents.iter_rows()
     }
-    for season in ["SUMMER", "AUTUMN", "WINTER", "SPRING"]:
-        sql = """
-        WITH reads AS (
-        SELECT
-        (CASE WHEN CAST(strftime('%m', cr.t_start) AS INTEGER) < 3 THEN 'SUMMER'
-        ELSE (CASE WHEN CAST(strftime('%m', cr.t_start) AS INTEGER) < 6 THEN 'AUTUMN'
-        ELSE (CASE WHEN CAST(strftime('%m', cr.t_start) AS INTEGER) < 9 THEN 'WINTER'
-        ELSE (CASE WHEN CAST(strftime('%m', cr.t_start) AS INTEGER) < 12 THEN 'SPRING'
-        ELSE 'SUMMER' END) END) END) END) season,
-        strftime('%H:%M', cr.t_start) AS time,
-        cr.nmi, cr.t_start, cr.t_end, cr.value
-        FROM combined_readings cr
-        LEFT JOIN (SELECT NMI, MAX(last_interval) as last_interval FROM nmi_summary
-        GROUP BY NMI) li ON li.nmi = cr.nmi
-        WHERE cr.t_start >= DATETIME(li.last_interval, '-366 days')
-        AND cr.nmi = :nmi
+
+
+def pivot_day_profile(df: pd.DataFrame) -> pd.DataFrame:
+    """Pivot summed readings into average kW by time, overall and per season
+
+    Expects `season`, `time`, `total` and `num` columns. Seasons without
+    readings are left out, and times missing from a season are NaN.
+    """
+    scale = 60 / SET_INTERVAL
+    overall = df.groupby("time")[["total", "num"]].sum()
+    sums = df.pivot_table(index="time", columns="season", values="total", aggfunc="sum")
+    nums = df.pivot_table(index="time", columns="season", values="num", aggfunc="sum")
+    seasons = (sums / nums * scale).reindex(columns=[x for x in SEASONS if x in sums])
+    profile = (overall["total"] / overall["num"] * scale).rename("Avg kW")
+    result = pd.concat([profile, seasons], axis=1)
+    result.columns.name = None
+    return result.rename_axis("time").reset_index()
+
+
+def duration_curve(
+    values: np.ndarray, num_points: int = 1000
+) -> tuple[np.ndarray, np.ndarray]:
+    """Value met or exceeded for each fraction of time, at fixed quantiles
+
+    The first and last points are the exact maximum and minimum values.
+    """
+    fraction = np.linspace(0, 1, num_points + 1)
+    return fraction, np.quantile(values, 1 - fraction)
+
+
+@dataclass
+class NMIData:
+    """Interval and daily data for an NMI, shared by every report stage"""
+
+    nmi: str
+    t_start: np.ndarray  # datetime64 start of each interval
+    imp: np.ndarray  # import kWh per interval
+    exp: np.ndarray  # export kWh per interval
+    days: np.ndarray  # datetime64 day of each daily read
+    day_imp: np.ndarray
+    day_exp: np.ndarray
+
+    @property
+    def start(self) -> datetime:
+        return pd.Timestamp(self.t_start[0]).to_pydatetime()
+
+    @property
+    def end(self) -> datetime:
+        last = pd.Timestamp(self.t_start[-1]).to_pydatetime()
+        return last + timedelta(minutes=SET_INTERVAL)
+
+    def usage_df(self) -> pd.DataFrame:
+        """Import and export (as negative) energy for each interval"""
+        return pd.DataFrame(
+            data={"consumption": self.imp, "export": -self.exp},
+            index=pd.DatetimeIndex(self.t_start),
+        )
+
+    def day_df(self) -> pd.DataFrame:
+        """Import and export energy for each day"""
+        return pd.DataFrame(
+            data={"imp": self.day_imp, "exp": self.day_exp},
+            index=pd.DatetimeIndex(self.days),
         )
-        SELECT time, AVG(value)*12 as value
-        FROM reads
-        WHERE season = :season
-        GROUP BY time
+
+    def usage_matrix(
+        self, slot_minutes: int = 15
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Average net kW for each day and time slot
+
+        Returns every day in the date range, the "HH:MM" label of each slot
+        and a days by slots matrix that is NaN where a slot has no readings.
         """
-        rows = list(db.query(sql, {"nmi": nmi, "season": season}))
-        data[season] = [x["value"] for x in rows]
-    df = pd.DataFrame(data=data)
-    return df
-
-
-def get_day_profiles(nmi: str):
-    sql = """
-    WITH reads AS (
-    SELECT
-		strftime('%Y-%m-%d', cr.t_start) AS day,
-        strftime('%H:%M', cr.t_start) AS time,
-        cr.nmi, cr.t_start, cr.t_end, cr.value
-    FROM combined_readings cr
-    LEFT JOIN (SELECT NMI, MAX(last_interval) as last_interval FROM nmi_summary
-    GROUP BY NMI) li ON li.nmi = cr.nmi
-    WHERE cr.t_start >= DATETIME(li.last_interval, '-366 days')
-    AND cr.nmi = :nmi
+        days = self.t_start.astype("datetime64[D]")
+        minutes = (self.t_start - days).astype("timedelta64[m]").astype(int)
+        day_idx = (days - days[0]).astype(int)
+        num_days = day_idx[-1] + 1
+        num_slots = 24 * 60 // slot_minutes
+        cells = day_idx * num_slots + minutes // slot_minutes
+        size = num_days * num_slots
+        kw = (self.imp - self.exp) * (60 / SET_INTERVAL)
+        totals = np.bincount(cells, weights=kw, minlength=size)
+        counts = np.bincount(cells, minlength=size)
+        with np.errstate(invalid="ignore"):
+            power = (totals / counts).reshape(num_days, num_slots)
+        all_days = days[0] + np.arange(num_days)
+        labels = TIME_LABELS[np.arange(num_slots) * slot_minutes]
+        return all_days, labels, power
+
+    def power_by_year(self) -> list[tuple[datetime, datetime, np.ndarray]]:
+        """Net kW of each interval in 366 day periods, most recent first"""
+        power = (self.imp - self.exp) * (60 / SET_INTERVAL)
+        periods = []
+        period_end = self.end
+        while period_end > self.start:
+            period_start = period_end - timedelta(days=366)
+            bounds = np.array([period_start, period_end], dtype="datetime64[s]")
+            first, last = np.searchsorted(self.t_start, bounds)
+            first_day = max(period_start, self.start)
+            periods.append((first_day, period_end, power[first:last]))
+            period_end = period_start
+        return periods
+
+    @cached_property
+    def latest_year(self) -> pd.DataFrame:
+        """Net energy of each interval in the most recent 366 days"""
+        cutoff = np.datetime64(self.end - timedelta(days=366))
+        mask = self.t_start >= cutoff
+        t_start = self.t_start[mask]
+        minutes = (t_start - t_start.astype("datetime64[D]")).astype("timedelta64[m]")
+        months = t_start.astype("datetime64[M]").astype(int) % 12
+        return pd.DataFrame(
+            data={
+                "day": np.datetime_as_string(t_start, unit="D"),
+                "minute": minutes.astype(int),
+                "season": MONTH_SEASONS[months],
+                "kWh": self.imp[mask] - self.exp[mask],
+            }
+        )
+
+    def day_profile(self) -> pd.DataFrame:
+        """Average net kW by time of day, overall and for each season"""
+        df = self.latest_year.groupby(["season", "minute"], as_index=False).agg(
+            total=("kWh", "sum"), num=("kWh", "size")
+        )
+        df["time"] = TIME_LABELS[df["minute"]]
+        return pivot_day_profile(df)
+
+    def day_profile_bands(self, percentiles=(10, 50, 90)) -> pd.DataFrame:
+        """Percentiles of the daily profiles for each time of day"""
+        days = self.day_profiles().pivot(index="day", columns="time", values="Avg kW")
+        values = np.nanpercentile(days.to_numpy(), percentiles, axis=0)
+        data = {f"p{p}": x for p, x in zip(percentiles, values, strict=True)}
+        return pd.DataFrame(data={"time": days.columns, **data})
+
+    def day_profiles(self) -> pd.DataFrame:
+        """Average net kW for each interval of each day"""
+        df = self.latest_year
+        return pd.DataFrame(
+            data={
+                "day": df["day"],
+                "time": TIME_LABELS[df["minute"]],
+                "Avg kW": df["kWh"] * (60 / SET_INTERVAL),
+            }
+        )
+
+
+@timed
+def load_nmi_data(nmi: str) -> NMIData:
+    """Read the interval and daily data for an NMI in one pass"""
+    t_start, imp, exp = get_cached_interval_arrays(nmi)
+    sql = "SELECT day, imp, exp FROM daily_reads WHERE nmi = :nmi ORDER BY day"
+    days = pd.DataFrame(get_db().query(sql, {"nmi": nmi}))
+
+    return NMIData(
+        nmi=nmi,
+        t_start=t_start,
+        imp=imp,
+        exp=exp,
+        days=pd.to_datetime(days["day"], format="%Y-%m-%d").to_numpy(),
+        day_imp=days["imp"].to_numpy(),
+        day_exp=days["exp"].to_numpy(),
     )
-    SELECT day, time, AVG(value)*12 as value
-    FROM reads
-    GROUP BY day, time
-    """
-    rows = list(db.query(sql, {"nmi": nmi}))
-    data = {
-        "day": [x["day"] for x in rows],
-        "time": [x["time"] for x in rows],
-        "Avg kW": [x["value"] for x in rows],
-    }
-    df = pd.DataFrame(data=data)
-    return df
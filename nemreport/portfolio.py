@@ -0,0 +1,130 @@
+"""Summarise a whole fleet of NMIs for the portfolio page
+
+The fleet is aggregated from the 30 minute rollup into totals for each half
+hour, so memory grows with the length of the period rather than the number
+of NMIs.
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from .model import get_db
+from .profiling import timed
+
+BUCKET = np.timedelta64(30, "m")
+SLOTS = 48  # Half hours in a day
+
+
+@dataclass
+class FleetSummary:
+    """Fleet kWh for each half hour of a period, and totals for each NMI"""
+
+    start: np.datetime64
+    imp: np.ndarray
+    exp: np.ndarray
+    reporting: np.ndarray  # Number of NMIs with data in each half hour
+    nmis: list[dict]
+
+    @property
+    def num_days(self) -> int:
+        return len(self.imp) // SLOTS
+
+    @property
+    def times(self) -> np.ndarray:
+        return self.start + np.arange(len(self.imp)) * BUCKET
+
+    @property
+    def total_imp(self) -> float:
+        return float(self.imp.sum())
+
+    @property
+    def total_exp(self) -> float:
+        return float(self.exp.sum())
+
+    @property
+    def peak_kw(self) -> float:
+        """Highest demand of all NMIs at the same time"""
+        return float(self.imp.max() * 2) if len(self.imp) else 0.0
+
+    @property
+    def peak_time(self) -> pd.Timestamp | None:
+        if not self.peak_kw:
+            return None
+        return pd.Timestamp(self.times[self.imp.argmax()])
+
+    @property
+    def diversity_factor(self) -> float | None:
+        """Sum of each NMI's own peak over the coincident peak"""
+        if not self.peak_kw:
+            return None
+        return sum(x["peak_kw"] for x in self.nmis) / self.peak_kw
+
+    def day_grid(self, values: np.ndarray) -> np.ndarray:
+        """Average kW for each day (rows) and half hour (columns)"""
+        kw = values[: self.num_days * SLOTS] * 2
+        grid = kw.reshape(self.num_days, SLOTS)
+        reported = self.reporting[: self.num_days * SLOTS].reshape(grid.shape)
+        return np.where(reported > 0, grid, np.nan)
+
+    def day_profile(self) -> pd.DataFrame:
+        """Average fleet kW at each time of day"""
+        times = pd.date_range("2000-01-01", periods=SLOTS, freq="30min")
+        with np.errstate(invalid="ignore"):
+            return pd.DataFrame(
+                {
+                    "time": times.strftime("%H:%M"),
+                    "imp": np.nanmean(self.day_grid(self.imp), axis=0),
+                    "exp": np.nanmean(self.day_grid(self.exp), axis=0),
+                }
+            )
+
+    def ranking(self, top: int | None = None) -> list[dict]:
+        """NMIs with the most import first"""
+        return sorted(self.nmis, key=lambda x: x["imp"], reverse=True)[:top]
+
+
+FLEET_SQL = """SELECT t_start, SUM(imp), SUM(exp), COUNT(*) FROM rollup_30min
+WHERE t_start >= :start AND t_start < :end GROUP BY t_start"""
+NMI_SQL = """SELECT nmi, COUNT(*), SUM(imp), SUM(exp), MAX(imp) FROM rollup_30min
+WHERE t_start >= :start AND t_start < :end GROUP BY nmi"""
+
+
+@timed
+def load_fleet_summary(days: int = 365) -> FleetSummary:
+    """Sum the last year of 30 minute data across every NMI
+
+    SQLite does the aggregation, so only one row per half hour and one per
+    NMI are brought into Python however many NMIs there are.
+    """
+    db = get_db()
+    last = db.execute("SELECT MAX(last_interval) FROM nmi_extent").fetchone()[0]
+    if last is None:
+        empty = np.zeros(0)
+        return FleetSummary(np.datetime64("NaT", "m"), empty, empty, empty, [])
+
+    end = np.datetime64(last, "D")
+    start = (end - np.timedelta64(days, "D")).astype("datetime64[m]")
+    params = {"start": str(start), "end": str(end)}
+    imp = np.zeros(days * SLOTS)
+    exp = np.zeros(days * SLOTS)
+    reporting = np.zeros(days * SLOTS, dtype=np.int32)
+    dtype = [("t_start", "U19"), ("imp", "f8"), ("exp", "f8"), ("count", "i4")]
+    rows = np.array(db.execute(FLEET_SQL, params).fetchall(), dtype=dtype)
+    idx = (rows["t_start"].astype("datetime64[m]") - start) // BUCKET
+    imp[idx], exp[idx], reporting[idx] = rows["imp"], rows["exp"], rows["count"]
+
+    stats = []
+    for nmi, count, nmi_imp, nmi_exp, peak in db.execute(NMI_SQL, params):
+        stats.append(
+            {
+                "nmi": nmi,
+                "days": round(count / SLOTS, 1),
+                "imp": nmi_imp,
+                "exp": nmi_exp,
+                "peak_kw": peak * 2,
+                "load_factor": nmi_imp / count / peak if peak else None,
+            }
+        )
+    return FleetSummary(start, imp, exp, reporting, stats)
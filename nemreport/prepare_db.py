@@ -1,22 +1,514 @@
+import hashlib
+import logging
+import multiprocessing
+import queue
+import time
+from collections.abc import Generator
+from multiprocessing import Queue
 from pathlib import Path
 
-from nemreader import extend_sqlite, output_folder_as_sqlite
+from nemreader import NEMFile
+from nemreader.output_db import calc_nmi_daily_summary
+from nemreader.split_days import make_set_interval, split_multiday_reads
 from sqlite_utils import Database
 
+log = logging.getLogger(__name__)
 DEFAULT_DIR = Path("data/")
+DB_FILE = "nemdata.db"
+SET_INTERVAL = 5
+# Indexes created after ingestion, by name: (table, columns)
+INDEXES = {
+    "idx_readings_nmi_t_start": ("readings", ["nmi", "t_start", "channel", "value"]),
+}
+# Rollup tables by name: (source table, SQL for the period of a source t_start)
+ROLLUPS = {
+    "rollup_30min": (
+        "readings",
+        "substr(t_start, 1, 14) ||"
+        " (CASE WHEN substr(t_start, 15, 2) < '30' THEN '00:00' ELSE '30:00' END)",
+    ),
+    "rollup_hour": ("rollup_30min", "substr(t_start, 1, 13) || ':00:00'"),
+    "rollup_day": ("rollup_hour", "substr(t_start, 1, 10)"),
+    "rollup_month": ("rollup_day", "substr(t_start, 1, 7)"),
+}
+ROLLUP_COLUMNS = [
+    "imp",
+    "exp",
+    "imp_morning",
+    "imp_day",
+    "imp_evening",
+    "imp_night",
+]
+QUERY_TABLES = ["nmi_extent", *ROLLUPS]
+OBSOLETE_TABLES = ["combined_readings"]  # Kept by older versions, no longer read
+READING_COLUMNS = {
+    "nmi": str,
+    "channel": str,
+    "t_start": str,
+    "t_end": str,
+    "value": float,
+    "quality_method": str,
+    "event_code": str,
+    "event_desc": str,
+}
+EXTENT_COLUMNS = {
+    "nmi": str,
+    "first_interval": str,
+    "last_interval": str,
+    "num_readings": int,
+    "total_value": float,  # Changes when revised reads replace earlier ones
+}
+BATCH_SIZE = 20_000  # Readings sent from a parser to the writer at a time
+COMMIT_ROWS = 500_000  # Readings written in each transaction
+PROGRESS_SECONDS = 5
 
 
-def update_nem_database(output_dir: Path = DEFAULT_DIR):
-    db_path = output_folder_as_sqlite(
-        file_dir=output_dir,
-        output_dir=output_dir,
-        split_days=True,
-        set_interval=5,
+def get_nem_files(file_dir: Path) -> list[Path]:
+    """List the NEM12/NEM13 files in a folder"""
+    nem_files = list(file_dir.glob("*.csv"))
+    nem_files += list(file_dir.glob("*.zip"))
+    return sorted(nem_files)
+
+
+def file_hash(file_path: Path) -> str:
+    """Hash the contents of a file"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_changed_files(db: Database, file_dir: Path) -> list[dict]:
+    """Get manifest entries for files that are new or changed since last import
+
+    Files with the same size and mtime as the manifest are assumed unchanged.
+    Otherwise the content hash decides, so a touched but identical file is
+    not parsed again.
+    """
+    manifest = {}
+    if "ingest_manifest" in db.table_names():
+        manifest = {row["path"]: row for row in db["ingest_manifest"].rows}
+
+    changed = []
+    for file_path in get_nem_files(file_dir):
+        stat = file_path.stat()
+        entry = {
+            "path": file_path.name,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+        }
+        prev = manifest.get(entry["path"])
+        if prev and (prev["size"], prev["mtime"]) == (entry["size"], entry["mtime"]):
+            continue
+        entry["sha256"] = file_hash(file_path)
+        if prev and prev["sha256"] == entry["sha256"]:
+            db["ingest_manifest"].upsert(entry, pk="path")
+            continue
+        changed.append(entry)
+    return changed
+
+
+def read_nem_readings(file_path: Path) -> Generator[tuple, None, None]:
+    """Read a NEM file as rows for the readings table
+
+    nemreader parses the whole file into memory first, so memory use grows
+    with the size of the file even though the rows are yielded one at a time.
+    """
+    m = NEMFile(file_path, strict=False).nem_data()
+    for nmi, nmi_readings in m.readings.items():
+        for ch in m.transactions[nmi]:
+            reads = split_multiday_reads(nmi_readings[ch])
+            for x in make_set_interval(list(reads), SET_INTERVAL):
+                yield (
+                    nmi,
+                    ch,
+                    x.t_start.isoformat(),
+                    x.t_end.isoformat(),
+                    x.read_value,
+                    x.quality_method,
+                    x.event_code,
+                    x.event_desc,
+                )
+
+
+def parse_nem_file(file_path: Path, batch_size: int = BATCH_SIZE):
+    """Read a NEM file as messages for the database writer
+
+    Readings are sent in batches, followed by a message that the file is done
+    or that it could not be read.
+    """
+    batch = []
+    try:
+        for row in read_nem_readings(file_path):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield ("rows", batch)
+                batch = []
+    except Exception as e:
+        yield ("error", file_path.name, repr(e))
+        return
+    if batch:
+        yield ("rows", batch)
+    yield ("done", file_path.name)
+
+
+def parse_worker(tasks: Queue, results: Queue, batch_size: int) -> None:
+    """Parse files from the task queue until it sends None"""
+    for file_path in iter(tasks.get, None):
+        for message in parse_nem_file(file_path, batch_size):
+            results.put(message)
+
+
+def parallel_messages(
+    files: list[Path], jobs: int, batch_size: int
+) -> Generator[tuple, None, None]:
+    """Parse files in worker processes and yield their messages
+
+    The result queue is bounded, so workers wait while the writer catches up
+    and the batches waiting to be written do not grow with the number of
+    files. Each worker still holds the file it is parsing in memory, so peak
+    memory is about one parsed file per job.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    tasks, results = ctx.Queue(), ctx.Queue(maxsize=jobs * 2)
+    for file_path in files:
+        tasks.put(file_path)
+    workers = [
+        ctx.Process(target=parse_worker, args=(tasks, results, batch_size))
+        for _ in range(min(jobs, len(files)))
+    ]
+    for worker in workers:
+        tasks.put(None)
+        worker.start()
+    remaining = len(files)
+    try:
+        while remaining:
+            try:
+                message = results.get(timeout=1)
+            except queue.Empty:
+                if not any(x.is_alive() for x in workers):
+                    msg = "NEM file parsers stopped before finishing"
+                    raise RuntimeError(msg) from None
+                continue
+            if message[0] != "rows":
+                remaining -= 1
+            yield message
+    finally:
+        for worker in workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+
+
+def configure_writer(db: Database) -> None:
+    """Tune the connection for large batched writes"""
+    db.enable_wal()
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.execute("PRAGMA temp_store = MEMORY")
+    db.execute("PRAGMA cache_size = -65536")  # 64 MiB
+
+
+def write_readings(db: Database, messages, entries: list[dict]) -> set[str]:
+    """Write parsed readings to the database and return the NMIs updated
+
+    Rows are inserted in large transactions. A file is only added to the
+    ingestion manifest in the transaction that holds its last readings, so a
+    file that fails or is interrupted is imported again next time.
+    """
+    db["readings"].create(
+        {column: READING_COLUMNS[column] for column in READING_COLUMNS},
+        pk=("nmi", "channel", "t_start"),
+        if_not_exists=True,
+    )
+    db["ingest_manifest"].create(
+        {"path": str, "size": int, "mtime": float, "sha256": str},
+        pk="path",
+        if_not_exists=True,
+    )
+    sql = f"""INSERT OR REPLACE INTO readings ({", ".join(READING_COLUMNS)})
+    VALUES ({", ".join("?" * len(READING_COLUMNS))})"""
+    manifest_sql = """INSERT OR REPLACE INTO ingest_manifest (path, size, mtime, sha256)
+    VALUES (:path, :size, :mtime, :sha256)"""
+    manifest = {x["path"]: x for x in entries}
+    nmis = set()
+    num_files, num_rows, pending = 0, 0, 0
+    start = last_log = time.perf_counter()
+
+    def log_progress():
+        elapsed = time.perf_counter() - start
+        log.info(
+            "Imported %s of %s files, %s rows (%.1f files/s, %.0f rows/s)",
+            num_files,
+            len(entries),
+            num_rows,
+            num_files / elapsed,
+            num_rows / elapsed,
+        )
+
+    for message in messages:
+        kind = message[0]
+        if kind == "rows":
+            batch = message[1]
+            db.conn.executemany(sql, batch)
+            nmis.update(row[0] for row in batch)
+            num_rows += len(batch)
+            pending += len(batch)
+        elif kind == "done":
+            db.conn.execute(manifest_sql, manifest[message[1]])
+            num_files += 1
+        else:
+            log.error("Unable to import %s: %s", message[1], message[2])
+            num_files += 1
+        if pending >= COMMIT_ROWS:
+            db.conn.commit()
+            pending = 0
+        if time.perf_counter() - last_log > PROGRESS_SECONDS:
+            log_progress()
+            last_log = time.perf_counter()
+    db.conn.commit()
+    log_progress()
+    return nmis
+
+
+def import_nem_files(
+    db: Database, file_dir: Path, entries: list[dict], jobs: int = 1
+) -> set[str]:
+    """Parse the given files, in parallel if asked, and write their readings"""
+    files = [file_dir / x["path"] for x in entries]
+    if jobs > 1 and len(files) > 1:
+        messages = parallel_messages(files, jobs, BATCH_SIZE)
+    else:
+        messages = (x for fp in files for x in parse_nem_file(fp, BATCH_SIZE))
+    return write_readings(db, messages, entries)
+
+
+def update_daily_reads(db_path: Path, nmis: set[str]) -> None:
+    """Recalculate the daily summaries for the given NMIs"""
+    db = Database(db_path)
+    for nmi in sorted(nmis):
+        if "daily_reads" in db.table_names():
+            db["daily_reads"].delete_where("nmi = :nmi", {"nmi": nmi})
+        items = calc_nmi_daily_summary(db_path, nmi)
+        db["daily_reads"].upsert_all(
+            items, pk=("nmi", "day"), column_order=("nmi", "day")
+        )
+    log.info("Updated day data for %s NMIs", len(nmis))
+
+
+def create_views(db: Database) -> None:
+    """Create the summary views used by the reports"""
+    db.create_view(
+        "nmi_summary",
+        """
+        SELECT nmi, channel, MIN(t_start) as first_interval, MAX(t_end) as last_interval
+        FROM readings
+        GROUP BY nmi, channel
+    """,
+        replace=True,
+    )
+
+    db.create_view(
+        "monthly_reads",
+        """
+    SELECT nmi, substr(day,1,7) as month,
+    count(day) as num_days, sum(imp) as imp, sum(exp) as exp,
+    sum(imp_morning) as imp_morning, sum(imp_day) as imp_day,
+    sum(imp_evening) as imp_evening, sum(imp_night) as imp_night
+    FROM daily_reads
+    GROUP BY nmi, substr(day,1,7)
+    ORDER BY 1, 2
+    """,
+        replace=True,
+    )
+
+    db.create_view(
+        "latest_year",
+        """
+    SELECT dr.nmi,
+    MIN(dr.day) as first_day,
+    MAX(dr.day) as last_day,
+    count(dr.day) as num_days,
+    sum(dr.imp) as imp,
+    sum(dr.exp) as exp,
+    sum(dr.imp_morning) as imp_morning,
+    sum(dr.imp_day) as imp_day,
+    sum(dr.imp_evening) as imp_evening,
+    sum(dr.imp_night) as imp_night
+    FROM daily_reads dr
+    LEFT JOIN nmi_extent li ON li.nmi = dr.nmi
+    WHERE dr.day >= DATETIME(li.last_interval, '-366 days')
+    GROUP BY dr.nmi
+    """,
         replace=True,
     )
+
+    db.create_view(
+        "latest_year_seasons",
+        """
+    SELECT dr.nmi,
+    (CASE WHEN CAST(strftime('%m', dr.day) AS INTEGER) < 3 THEN 'SUMMER'
+        ELSE (CASE WHEN CAST(strftime('%m', dr.day) AS INTEGER) < 6 THEN 'AUTUMN'
+        ELSE (CASE WHEN CAST(strftime('%m', dr.day) AS INTEGER) < 9 THEN 'WINTER'
+        ELSE (CASE WHEN CAST(strftime('%m', dr.day) AS INTEGER) < 12 THEN 'SPRING'
+        ELSE 'SUMMER' END) END) END) END) Season,
+    MIN(dr.day) as first_day,
+    MAX(dr.day) as last_day,
+    count(dr.day) as num_days,
+    sum(dr.imp) as imp,
+    sum(dr.exp) as exp,
+    sum(dr.imp_morning) as imp_morning,
+    sum(dr.imp_day) as imp_day,
+    sum(dr.imp_evening) as imp_evening,
+    sum(dr.imp_night) as imp_night
+    FROM daily_reads dr
+    LEFT JOIN nmi_extent li ON li.nmi = dr.nmi
+    WHERE dr.day >= DATETIME(li.last_interval, '-366 days')
+    GROUP BY dr.nmi,
+        (CASE WHEN CAST(strftime('%m', dr.day) AS INTEGER) < 3 THEN 'SUMMER'
+        ELSE (CASE WHEN CAST(strftime('%m', dr.day) AS INTEGER) < 6 THEN 'AUTUMN'
+        ELSE (CASE WHEN CAST(strftime('%m', dr.day) AS INTEGER) < 9 THEN 'WINTER'
+        ELSE (CASE WHEN CAST(strftime('%m', dr.day) AS INTEGER) < 12 THEN 'SPRING'
+        ELSE 'SUMMER' END) END) END) END)
+    """,
+        replace=True,
+    )
+
+
+def create_query_tables(db: Database) -> None:
+    """Create the indexes and materialised tables that report queries use"""
+    if "nmi_extent" in db.table_names() and outdated_extent(db):
+        db["nmi_extent"].drop()  # Refilled for every NMI by update_query_tables
+    db["nmi_extent"].create(EXTENT_COLUMNS, pk="nmi", if_not_exists=True)
+    for name in ROLLUPS:
+        db[name].create(
+            {"nmi": str, "t_start": str} | dict.fromkeys(ROLLUP_COLUMNS, float),
+            pk=("nmi", "t_start"),
+            if_not_exists=True,
+        )
+    for name, (table, columns) in INDEXES.items():
+        db[table].create_index(columns, index_name=name, if_not_exists=True)
+
+
+def outdated_extent(db: Database) -> bool:
+    return bool(set(EXTENT_COLUMNS) - set(db["nmi_extent"].columns_dict))
+
+
+def missing_indexes(db: Database) -> list[str]:
+    """List the expected indexes and materialised tables that do not exist"""
+    missing = []
+    tables = db.table_names()
+    for name, (table, _) in INDEXES.items():
+        if table not in tables or name not in {x.name for x in db[table].indexes}:
+            missing.append(name)
+    missing += [x for x in QUERY_TABLES if x not in tables]
+    if "nmi_extent" in tables and outdated_extent(db):
+        missing.append("nmi_extent")
+    return missing
+
+
+def drop_obsolete_tables(db: Database) -> None:
+    for name in OBSOLETE_TABLES:
+        if name in db.view_names():
+            db.view(name).drop()
+        elif name in db.table_names():
+            db.table(name).drop()
+            log.info("Dropped %s, which is no longer used", name)
+
+
+def update_query_tables(db: Database, nmis: set[str]) -> None:
+    """Refresh the interval extent for the given NMIs"""
+    with db.conn:
+        for nmi in sorted(nmis):
+            params = {"nmi": nmi}
+            db.execute("DELETE FROM nmi_extent WHERE nmi = :nmi", params)
+            db.execute(
+                """
+            INSERT INTO nmi_extent
+            (nmi, first_interval, last_interval, num_readings, total_value)
+            SELECT nmi, MIN(t_start), MAX(t_end), COUNT(*), TOTAL(value)
+            FROM readings WHERE nmi = :nmi
+            GROUP BY nmi
+            """,
+                params,
+            )
+    db.analyze()
+    log.info("Updated the interval extent for %s NMIs", len(nmis))
+
+
+def rollup_sql(name: str) -> str:
+    """SQL to fill a rollup table for one NMI from the next finest table"""
+    source, period = ROLLUPS[name]
+    columns = ", ".join(ROLLUP_COLUMNS)
+    if source == "readings":
+        # Split E channels by time of use and B channels as export
+        hour = "CAST(substr(t_start, 12, 2) AS INTEGER)"
+        imp = "(CASE WHEN substr(channel, 1, 1) = 'E' THEN value ELSE 0 END)"
+        sums = [
+            imp,
+            "(CASE WHEN substr(channel, 1, 1) = 'B' THEN value ELSE 0 END)",
+            f"(CASE WHEN {hour} >= 4 AND {hour} < 9 THEN {imp} ELSE 0 END)",
+            f"(CASE WHEN {hour} >= 9 AND {hour} < 16 THEN {imp} ELSE 0 END)",
+            f"(CASE WHEN {hour} >= 16 AND {hour} < 21 THEN {imp} ELSE 0 END)",
+            f"(CASE WHEN {hour} < 4 OR {hour} >= 21 THEN {imp} ELSE 0 END)",
+        ]
+    else:
+        sums = ROLLUP_COLUMNS
+    selects = ", ".join(f"ROUND(SUM({x}), 3)" for x in sums)  # Readings are 3dp
+    return f"""INSERT INTO {name} (nmi, t_start, {columns})
+    SELECT nmi, {period}, {selects}
+    FROM {source} WHERE nmi = :nmi
+    GROUP BY nmi, {period}"""
+
+
+def update_rollups(db: Database, nmis: set[str]) -> None:
+    """Refresh the 30 minute, hourly, daily and monthly rollups for the NMIs
+
+    Each rollup is summed from the one below it, so only the 30 minute table
+    reads the interval data.
+    """
+    with db.conn:
+        for nmi in sorted(nmis):
+            for name in ROLLUPS:
+                db.execute(f"DELETE FROM {name} WHERE nmi = :nmi", {"nmi": nmi})
+                db.execute(rollup_sql(name), {"nmi": nmi})
+    log.info("Updated rollups for %s NMIs", len(nmis))
+
+
+def update_nem_database(
+    output_dir: Path = DEFAULT_DIR, full: bool = False, jobs: int = 1
+) -> Path:
+    """Import new or changed NEM files into the database
+
+    Only files that differ from the ingestion manifest are parsed, and only
+    the NMIs found in those files have their daily summaries recalculated.
+    Set `full` to rebuild the database from every file instead, and `jobs`
+    to parse files in that many worker processes.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    db_path = output_dir / DB_FILE
+    if full:
+        for suffix in ["", "-wal", "-shm"]:  # Clear existing database files
+            db_path.with_name(db_path.name + suffix).unlink(missing_ok=True)
     db = Database(db_path)
+    configure_writer(db)
+
+    changed = get_changed_files(db, output_dir)
+    nmis = set()
+    if changed:
+        nmis = import_nem_files(db, output_dir, changed, jobs)
+
     if "readings" not in db.table_names():
         msg = "No data. Copy some NEM12 files into the data folder first"
         raise FileNotFoundError(msg)
-    extend_sqlite(db_path)
+    if missing_indexes(db):
+        # Build the query tables for every NMI in an older database
+        nmis = {row["nmi"] for row in db.query("SELECT DISTINCT nmi FROM readings")}
+        create_query_tables(db)
+    drop_obsolete_tables(db)
+    create_views(db)
+    if nmis:
+        update_daily_reads(db_path, nmis)
+        update_query_tables(db, nmis)
+        update_rollups(db, nmis)
     return db_path
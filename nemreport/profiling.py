@@ -0,0 +1,131 @@
+"""Lightweight timing spans for the report build stages and queries"""
+
+import csv
+import json
+import sys
+import time
+from collections.abc import Callable, Generator
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+SPAN_FIELDS = ["nmi", "stage", "seconds", "rows", "bytes", "peak_rss_growth_mb"]
+enabled = False
+spans: list[dict] = []
+
+
+def enable(on: bool = True) -> None:
+    """Turn span recording on or off for this process"""
+    global enabled
+    enabled = on
+
+
+def take_spans() -> list[dict]:
+    """Return the spans recorded so far and start a new list"""
+    global spans
+    recorded, spans = spans, []
+    return recorded
+
+
+def peak_rss_mb() -> float | None:
+    """Peak resident memory of this process so far"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / 1024**2 if sys.platform == "darwin" else rss / 1024, 1)
+
+
+def result_size(result) -> dict:
+    """Row count or output bytes of a stage result"""
+    if isinstance(result, str):
+        return {"bytes": len(result.encode())}
+    if isinstance(result, Path) and result.exists():
+        return {"bytes": result.stat().st_size}
+    if isinstance(result, tuple) and result and hasattr(result[0], "__len__"):
+        return {"rows": len(result[0])}
+    if isinstance(result, dict) and all(isinstance(x, str) for x in result.values()):
+        return {"bytes": sum(len(x.encode()) for x in result.values())}
+    if hasattr(result, "t_start"):  # NMIData
+        return {"rows": len(result.t_start)}
+    if hasattr(result, "__len__"):
+        return {"rows": len(result)}
+    return {}
+
+
+@contextmanager
+def span(stage: str, nmi: str | None = None) -> Generator[dict, None, None]:
+    """Record the wall time of a block of code and how much it raised the peak
+    memory of the process, which stays at zero while it fits under an earlier peak
+    """
+    record = {"nmi": nmi, "stage": stage, "rows": None, "bytes": None}
+    if not enabled:
+        yield record
+        return
+    start_rss = peak_rss_mb()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 6)
+        if start_rss is not None:
+            record["peak_rss_growth_mb"] = round(peak_rss_mb() - start_rss, 1)
+        spans.append(record)
+
+
+def timed(func: Callable) -> Callable:
+    """Record a span for each call while profiling is enabled"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        first = args[0] if args else None
+        nmi = first if isinstance(first, str) else getattr(first, "nmi", None)
+        with span(func.__name__, nmi) as record:
+            result = func(*args, **kwargs)
+            record.update(result_size(result))
+        return result
+
+    return wrapper
+
+
+def summarise(records: list[dict]) -> list[dict]:
+    """Total time of each stage across all NMIs, slowest first"""
+    stages = {}
+    for x in records:
+        row = stages.setdefault(
+            x["stage"], {"stage": x["stage"], "calls": 0, "seconds": 0.0, "max": 0.0}
+        )
+        row["calls"] += 1
+        row["seconds"] += x["seconds"]
+        row["max"] = max(row["max"], x["seconds"])
+    return sorted(stages.values(), key=lambda x: x["seconds"], reverse=True)
+
+
+def format_summary(records: list[dict], top: int = 10) -> str:
+    """Table of the slowest stages"""
+    lines = [f"{'stage':<30}{'calls':>7}{'total s':>10}{'mean s':>10}{'max s':>10}"]
+    for x in summarise(records)[:top]:
+        mean = x["seconds"] / x["calls"]
+        lines.append(
+            f"{x['stage']:<30}{x['calls']:>7}{x['seconds']:>10.3f}"
+            f"{mean:>10.3f}{x['max']:>10.3f}"
+        )
+    return "\n".join(lines)
+
+
+def write_profile(records: list[dict], output_dir: Path) -> Path:
+    """Save the spans as profile.json and profile.csv"""
+    file_path = output_dir / "profile.json"
+    with open(file_path, "w") as fh:
+        json.dump({"spans": records, "summary": summarise(records)}, fh, indent=2)
+    with open(output_dir / "profile.csv", "w", newline="") as fh:
+        writer = csv.DictWriter(fh, fieldnames=SPAN_FIELDS)
+        writer.writeheader()
+        writer.writerows(records)
+    return file_path
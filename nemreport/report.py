@@ -1,39 +1,70 @@
+import cProfile
+import hashlib
+import json
 import logging
-import shutil
+import multiprocessing
 import webbrowser
-from calendar import monthrange
-from datetime import datetime, time
+from collections.abc import Callable
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, replace
+from datetime import datetime
+from functools import partial
 from pathlib import Path
+from typing import Any
 
 import calplot
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from jinja2 import Environment, FileSystemLoader
-from nemreader import extend_sqlite
-from nemreader.output_db import get_nmis
 import polars as pl
+from great_tables import GT
+from jinja2 import Environment, FileSystemLoader
+from plotly.offline import get_plotlyjs_version
+from plotly.subplots import make_subplots
 
-from great_tables import GT, md, html
+from . import model
+from .bundle import PLOTLY_JS, STYLESHEET, precompress, write_assets
 from .model import (
-    DB_PATH,
-    db,
-    get_annual_data,
-    get_date_range,
-    get_day_data,
-    get_day_profile,
-    get_day_profiles,
-    get_season_data,
-    get_usage_df,
+    TIME_LABELS,
+    NMIData,
+    NMISummary,
+    connect,
+    duration_curve,
+    get_nmi_fingerprint,
+    get_nmi_list,
+    load_nmi_data,
+    load_summaries,
+    set_data_dir,
 )
+from .portfolio import SLOTS, FleetSummary, load_fleet_summary
 from .prepare_db import update_nem_database
+from .profiling import enable, format_summary, span, take_spans, timed, write_profile
+from .tariffs import (
+    Tariff,
+    TariffEngine,
+    UsageGrid,
+    find_tariff_file,
+    load_tariffs,
+    tariff_file_hash,
+)
+from .version import __version__
 
 log = logging.getLogger(__name__)
 this_dir = Path(__file__).parent
 template_dir = this_dir / "templates"
 env = Environment(loader=FileSystemLoader(template_dir))
 output_dir = Path("output")
-output_dir.mkdir(exist_ok=True)
+PROFILES_MODES = ["lines", "bands", "both"]
+CALENDAR_RENDERERS = ["calplot", "plotly"]
+matplotlib.use("Agg")  # Render calendars without a GUI backend
 
 
 def format_month(dt: datetime) -> str:
@@ -41,58 +72,161 @@ def format_month(dt: datetime) -> str:
 
 
 env.filters["yearmonth"] = format_month
+env.globals |= {
+    "offline": False,
+    "plotly_cdn": f"https://cdn.plot.ly/plotly-{get_plotlyjs_version()}.min.js",
+    "plotly_js": PLOTLY_JS,
+    "stylesheet": STYLESHEET,
+}
 
 
-def build_daily_usage_chart(nmi: str, kind: str) -> Path | None:
-    """Save calendar plot"""
-    days = []
-    data = []
-    for (
-        dt,
-        imp,
-        exp,
-    ) in get_day_data(nmi):
-        days.append(dt)
-        if kind == "import":
-            data.append(imp)
-        elif kind == "export":
-            data.append(exp)
-        elif kind == "total":
-            exp = -exp  # Make export negative
-            val = imp + exp
-            data.append(val)
-        else:
-            raise ValueError("Invalid usage chart kind")
+def configure(data_dir: Path, out_dir: Path, offline: bool = False) -> None:
+    """Set the folders to read data from and write reports to
 
-    if kind == "export" and max(data) == 0.0:
-        return None
+    Offline reports load plotly.js and their styles from output/assets rather
+    than from a CDN.
+    """
+    global output_dir
+    set_data_dir(data_dir)
+    output_dir = Path(out_dir)
+    env.globals["offline"] = offline
+
+
+def save_fragment(html: str, file_name: str) -> Path:
+    """Save a copy of a report fragment"""
+    file_path = output_dir / file_name
+    with open(file_path, "w", encoding="utf-8") as fh:
+        fh.write(html)
+    log.info("Created %s", file_path)
+    return file_path
 
-    vmin = max(-35, min(data))
-    vmax = min(35, max(data))
 
-    data = pd.Series(data, index=days)
-    plot = calplot.calplot(
+def compact_figure(fig: go.Figure) -> go.Figure:
+    """Store float64 trace data as float32 to halve its encoded size"""
+    for trace in fig.data:
+        for attr in [x for x in ("x", "y", "z") if x in trace]:
+            value = trace[attr]
+            if isinstance(value, np.ndarray) and value.dtype == np.float64:
+                trace[attr] = value.astype(np.float32)
+    return fig
+
+
+def figure_fragment(fig: go.Figure, file_name: str, keep_fragments: bool) -> str:
+    """Get the HTML for a figure, also saving it if fragments are kept
+
+    Pages load plotly.js once in their head, so it is only included in the
+    saved copy of the fragment.
+    """
+    html = compact_figure(fig).to_html(full_html=False, include_plotlyjs=False)
+    if keep_fragments:
+        src = PLOTLY_JS if env.globals["offline"] else env.globals["plotly_cdn"]
+        save_fragment(f'<script src="{src}"></script>\n{html}', file_name)
+    return html
+
+
+def calendar_series(nmi_data: NMIData) -> dict[str, pd.Series]:
+    """Daily kWh for each calendar chart, from one pass over the day data"""
+    df = nmi_data.day_df()
+    series = {
+        "import": df["imp"],
+        "export": df["exp"],
+        "total": df["imp"] - df["exp"],  # Make export negative
+    }
+    if not len(df) or df["exp"].max() == 0.0:
+        del series["export"]
+    return series
+
+
+def calplot_calendar(nmi: str, data: pd.Series, kind: str) -> str:
+    """Save a calplot calendar as a PNG and return the HTML to show it"""
+    fig, _ = calplot.calplot(
         data,
         suptitle=f"Daily kWh for {nmi} ({kind})",
         how=None,
-        vmin=vmin,
-        vmax=vmax,
+        vmin=max(-35, data.min()),
+        vmax=min(35, data.max()),
         cmap="YlOrRd",
         daylabels="MTWTFSS",
         colorbar=True,
     )
-    fig = plot[0]
     file_path = output_dir / f"{nmi}_daily_{kind}.png"
     fig.savefig(file_path, bbox_inches="tight")
+    plt.close(fig)  # Release the figure so memory stays flat across NMIs
     log.info("Created %s", file_path)
-    return file_path
+    return f'<img src="{file_path.name}" class="img-fluid">'
 
 
-def average_daily_profiles_fig(nmi: str) -> go.Figure:
-    try:
-        df = get_day_profile(nmi)
-    except ValueError:
-        return ""
+def calendar_fig(nmi: str, data: pd.Series, kind: str) -> go.Figure:
+    """Calendar heatmap with a row of weeks for each year"""
+    days = data.index
+    years = sorted(days.year.unique(), reverse=True)
+    fig = make_subplots(
+        rows=len(years),
+        cols=1,
+        subplot_titles=[str(x) for x in years],
+        vertical_spacing=0.3 / max(len(years), 1),
+    )
+    for row, year in enumerate(years, start=1):
+        in_year = days.year == year
+        year_days = days[in_year]
+        jan1 = pd.Timestamp(year=year, month=1, day=1)
+        first_monday = jan1 - pd.Timedelta(days=jan1.weekday())
+        fig.add_trace(
+            go.Heatmap(
+                x=((year_days - first_monday).days // 7).to_numpy(dtype=np.int16),
+                y=year_days.weekday.to_numpy(dtype=np.int8),
+                z=data[in_year].to_numpy(dtype=np.float32),
+                customdata=year_days.strftime("%a %d %b %Y"),
+                hovertemplate="%{customdata}<br>%{z:.1f} kWh<extra></extra>",
+                coloraxis="coloraxis",
+                xgap=2,
+                ygap=2,
+            ),
+            row=row,
+            col=1,
+        )
+        fig.update_yaxes(
+            tickvals=list(range(7)),
+            ticktext=list("MTWTFSS"),
+            autorange="reversed",
+            row=row,
+            col=1,
+        )
+    fig.update_xaxes(showticklabels=False, showgrid=False)
+    fig.update_layout(
+        title=f"Daily kWh for {nmi} ({kind})",
+        coloraxis={
+            "colorscale": "YlOrRd",
+            "cmin": max(-35, data.min()),
+            "cmax": min(35, data.max()),
+        },
+        height=160 * len(years) + 100,
+        plot_bgcolor="white",
+    )
+    return fig
+
+
+@timed
+def build_calendar_charts(
+    nmi_data: NMIData, renderer: str = "calplot", keep_fragments: bool = False
+) -> dict[str, str]:
+    """Build the daily usage calendars, returning the HTML for each kind"""
+    nmi = nmi_data.nmi
+    charts = {}
+    for kind, data in calendar_series(nmi_data).items():
+        if renderer == "calplot":
+            charts[kind] = calplot_calendar(nmi, data, kind)
+        elif renderer == "plotly":
+            fig = calendar_fig(nmi, data, kind)
+            file_name = f"{nmi}_daily_{kind}.html"
+            charts[kind] = figure_fragment(fig, file_name, keep_fragments)
+        else:
+            raise ValueError("Invalid calendar renderer")
+    return charts
+
+
+def average_daily_profiles_fig(nmi_data: NMIData) -> go.Figure:
+    df = nmi_data.day_profile()
     # trace = go.Scatter(x=df["time"], y=df["Avg kW"], name="Avg kW")
     traces = []
     color_dict = {
@@ -119,61 +253,146 @@ def average_daily_profiles_fig(nmi: str) -> go.Figure:
     return fig
 
 
-def build_day_profile_plot(nmi: str) -> str:
+@timed
+def build_day_profile_plot(nmi_data: NMIData, keep_fragments: bool = False) -> str:
     """Save profile plot"""
-
-    fig = average_daily_profiles_fig(nmi)
-    file_path = output_dir / f"{nmi}_day_profile.html"
-    fig.write_html(file_path, full_html=False, include_plotlyjs="cdn")
-    log.info("Created %s", file_path)
-    return file_path
+    nmi = nmi_data.nmi
+    fig = average_daily_profiles_fig(nmi_data)
+    return figure_fragment(fig, f"{nmi}_day_profile.html", keep_fragments)
 
 
-def load_duration_curve(nmi: str) -> go.Figure:
-    df = get_day_profiles(nmi)
-    fig = px.ecdf(
-        df,
-        y="Avg kW",
-        ecdfmode="complementary",
-    )
+def load_duration_curve(nmi_data: NMIData, compare_years: bool = False) -> go.Figure:
+    periods = nmi_data.power_by_year()
+    if not compare_years:
+        periods = periods[:1]
+    traces = []
+    for i, (start, end, power) in enumerate(periods):
+        if not len(power):
+            continue
+        fraction, kw = duration_curve(power)
+        name = "Last 12 months" if i == 0 else f"{start:%b %Y} to {end:%b %Y}"
+        trace = go.Scatter(x=fraction, y=kw, name=name, mode="lines")
+        traces.append(trace)
+    fig = go.Figure(data=traces)
     fig.update_layout(
         xaxis={"title": "", "dtick": 0.05, "tickformat": ",.0%", "range": [0, 1]},
+        yaxis_title="Avg kW",
+        showlegend=compare_years,
     )
     return fig
 
 
-def build_load_duration_curve(nmi: str) -> str:
+@timed
+def build_load_duration_curve(
+    nmi_data: NMIData, compare_years: bool = False, keep_fragments: bool = False
+) -> str:
     """Save profile plot"""
-    fig = load_duration_curve(nmi)
-    file_path = output_dir / f"{nmi}_load_duration_curve.html"
-    fig.write_html(file_path, full_html=False, include_plotlyjs="cdn")
-    log.info("Created %s", file_path)
-    return file_path
+    nmi = nmi_data.nmi
+    fig = load_duration_curve(nmi_data, compare_years)
+    return figure_fragment(fig, f"{nmi}_load_duration_curve.html", keep_fragments)
 
 
-def build_days_profiles_plot(nmi: str) -> str:
+def days_profiles_fig(nmi_data: NMIData, mode: str = "lines") -> go.Figure:
+    """Plot every daily profile as lines, as percentile bands, or both"""
+    if mode not in PROFILES_MODES:
+        raise ValueError("Invalid profiles mode")
+    traces = []
+    if mode in ["bands", "both"]:
+        bands = nmi_data.day_profile_bands()
+        minutes = np.searchsorted(TIME_LABELS, bands["time"])
+        band_color = "rgba(65, 105, 225, 0.3)"
+        traces += [
+            go.Scatter(x=minutes, y=bands["p10"], name="10th percentile", line_width=0),
+            go.Scatter(
+                x=minutes,
+                y=bands["p90"],
+                name="90th percentile",
+                line_width=0,
+                fill="tonexty",
+                fillcolor=band_color,
+            ),
+            go.Scatter(x=minutes, y=bands["p50"], name="Median"),
+        ]
+        for trace in traces:
+            trace.line.color = "royalblue"
+    if mode in ["lines", "both"]:
+        # One trace for all days, broken by a gap at the start of each day
+        df = nmi_data.day_profiles()
+        minutes = np.searchsorted(TIME_LABELS, df["time"]).astype(np.int16)
+        day = df["day"].to_numpy()
+        new_day = np.flatnonzero(day[1:] != day[:-1]) + 1
+        trace = go.Scatter(
+            x=np.insert(minutes, new_day, minutes[new_day]),
+            y=np.insert(df["Avg kW"].to_numpy(np.float32), new_day, np.nan),
+            name="Days",
+            mode="lines",
+            line_color="royalblue",
+            opacity=0.2 if mode == "both" else 1.0,
+        )
+        traces.insert(0, trace)
+    fig = go.Figure(data=traces)
+    for x in [4, 9, 16, 21]:
+        fig.add_vline(x=x * 60, line_width=1, line_dash="dash", line_color="black")
+    hours = np.arange(0, 24 * 60, 60)
+    fig.update_xaxes(title="time", tickvals=hours, ticktext=TIME_LABELS[hours])
+    fig.update_layout(yaxis_title="Avg kW", showlegend=False)
+    return fig
+
+
+@timed
+def build_days_profiles_plot(
+    nmi_data: NMIData, mode: str = "lines", keep_fragments: bool = False
+) -> str:
     """Save profile plot"""
-    df = get_day_profiles(nmi)
-    fig = px.line(df, x="time", y="Avg kW", color="day")
-    x_values = ["04:00", "09:00", "16:00", "21:00"]
-    for x in x_values:
-        fig.add_vline(x=x, line_width=1, line_dash="dash", line_color="black")
-    fig.update_xaxes(dtick=12)
-    fig.update_traces(line_color="royalblue", showlegend=False)
-    file_path = output_dir / f"{nmi}_days_profiles.html"
-    fig.write_html(file_path, full_html=False, include_plotlyjs="cdn")
-    log.info("Created %s", file_path)
-    return file_path
+    nmi = nmi_data.nmi
+    fig = days_profiles_fig(nmi_data, mode)
+    return figure_fragment(fig, f"{nmi}_days_profiles.html", keep_fragments)
+
 
+MAX_POINTS = 1000  # Most bars or heatmap rows a chart draws before resampling
+RESOLUTIONS = {"day": 1, "week": 7, "month": 31}  # Most days in each period
 
-def daily_total_fig(nmi: str) -> go.Figure:
-    day_data = list(get_day_data(nmi))
+
+def chart_resolution(num_days: int, max_points: int = MAX_POINTS) -> str:
+    """Finest of day, week or month that keeps a chart within its point budget
+
+    This keeps the size of the charts about the same however many years of
+    data an NMI has.
+    """
+    for resolution, days in RESOLUTIONS.items():
+        if num_days <= max_points * days:
+            return resolution
+    return "month"
+
+
+def resample_rows(
+    days: np.ndarray, values: np.ndarray, resolution: str
+) -> tuple[np.ndarray, np.ndarray]:
+    """Average the rows of a days by slots matrix over each week or month
+
+    Returns the first day of each period and its rows, ignoring NaN cells.
+    """
+    periods = pd.DatetimeIndex(days).to_period(resolution[0].upper())
+    starts = np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]])
+    has_data = ~np.isnan(values)
+    totals = np.add.reduceat(np.where(has_data, values, 0.0), starts)
+    counts = np.add.reduceat(has_data, starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = totals / counts
+    return periods[starts].start_time.to_numpy(), means
+
+
+def daily_total_fig(nmi_data: NMIData, max_points: int = MAX_POINTS) -> go.Figure:
+    day_df = nmi_data.day_df()
+    resolution = chart_resolution(len(day_df), max_points)
+    if resolution != "day":
+        periods = day_df.index.to_period(resolution[0].upper()).start_time
+        day_df = day_df.groupby(periods).sum()
     data = {
-        "import": [x[1] for x in day_data],
-        "export": [-x[2] for x in day_data],
+        "import": day_df["imp"],
+        "export": -day_df["exp"],
     }
-    index = [x[0] for x in day_data]
-    df = pd.DataFrame(index=index, data=data)
+    df = pd.DataFrame(index=day_df.index, data=data)
     color_dict = {
         "export": "green",
         "import": "orangered",
@@ -194,51 +413,49 @@ def daily_total_fig(nmi: str) -> go.Figure:
     )
     fig.update_layout(
         xaxis_title=None,
-        yaxis_title="kWh",
+        yaxis_title="kWh" if resolution == "day" else f"kWh per {resolution}",
     )
     return fig
 
 
-def build_daily_plot(nmi: str) -> str:
+@timed
+def build_daily_plot(
+    nmi_data: NMIData, keep_fragments: bool = False, max_points: int = MAX_POINTS
+) -> str:
     """Save daily totals plot"""
+    nmi = nmi_data.nmi
+    fig = daily_total_fig(nmi_data, max_points)
+    return figure_fragment(fig, f"{nmi}_daily_totals.html", keep_fragments)
 
-    fig = daily_total_fig(nmi)
-    file_path = output_dir / f"{nmi}_daily_totals.html"
-    fig.write_html(file_path, full_html=False, include_plotlyjs="cdn")
-    log.info("Created %s", file_path)
-    return file_path
 
+def usage_heatmap(
+    nmi_data: NMIData, max_points: int = MAX_POINTS
+) -> tuple[go.Figure, str]:
+    """Average kW for each time of day, with a row per day, week or month
 
-def usage_heatmap(nmi: str) -> go.Figure:
-    df = get_usage_df(nmi)
-    df["power"] = df["consumption"] + df["export"]
-    df["power"] = df["power"].apply(lambda x: x * 12)
-    has_export = len(df["export"].unique()) > 1
+    Returns the figure and the resolution its rows were drawn at.
+    """
+    days, times, power = nmi_data.usage_matrix()
+    resolution = chart_resolution(len(days), max_points)
+    if resolution != "day":
+        days, power = resample_rows(days, power, resolution)
+    has_export = len(np.unique(nmi_data.exp)) > 1
     colorscale = "Geyser" if has_export else "YlOrRd"
     midpoint = 0.0 if has_export else None
-    start, end = get_date_range(nmi)
-    numdays = (end - start).days
-    nbinsx = 96
-    nbinsy = numdays
     width = 800
-    height = 200 + int(numdays * 0.5)
-    fig = px.density_heatmap(
-        df,
-        width=width,
-        height=height,
-        x=df.index.time,
-        y=df.index.date,
-        z=df["power"],
-        nbinsx=nbinsx,
-        nbinsy=nbinsy,
-        histfunc="avg",
-        color_continuous_scale=colorscale,
-        color_continuous_midpoint=midpoint,
+    height = 200 + int(len(days) * 0.5)
+    trace = go.Heatmap(
+        x=times,
+        y=days,
+        z=power.astype(np.float32),
+        coloraxis="coloraxis",
+        hoverongaps=False,
     )
+    fig = go.Figure(data=trace)
 
-    datemin = min(df.index.date)
-    datemax = max(df.index.date)
-    x_values = [time(4, 0), time(9, 0), time(16, 0), time(21, 0)]
+    datemin = days[0]
+    datemax = days[-1]
+    x_values = ["04:00", "09:00", "16:00", "21:00"]
     for x in x_values:
         fig.add_shape(
             type="line",
@@ -250,76 +467,80 @@ def usage_heatmap(nmi: str) -> go.Figure:
         )
 
     fig.update_layout(
+        width=width,
+        height=height,
         xaxis_title=None,
         yaxis_title=None,
         margin=dict(l=20, r=20, t=20, b=20),
     )
-    fig.update_layout(coloraxis=dict(colorbar=dict(title="kW")))
+    fig.update_layout(
+        coloraxis=dict(colorscale=colorscale, cmid=midpoint, colorbar=dict(title="kW"))
+    )
     fig.update_yaxes(dtick="M1", tickformat="%b\n%Y", ticklabelmode="period")
-    fig.update_xaxes(dtick=12, tickformat="%H:%M")
-    return fig
+    fig.update_xaxes(dtick=12)
+    return fig, resolution
 
 
-def build_usage_heatmap(nmi: str) -> str:
-    """Save heatmap of power usage"""
+def save_year_heatmaps(nmi_data: NMIData) -> dict[int, str]:
+    """Save a full resolution heatmap page for each year of data"""
+    years = nmi_data.t_start.astype("datetime64[Y]")
+    src = PLOTLY_JS if env.globals["offline"] else "cdn"
+    files = {}
+    for year in np.unique(years):
+        keep = years == year
+        year_data = replace(
+            nmi_data,
+            t_start=nmi_data.t_start[keep],
+            imp=nmi_data.imp[keep],
+            exp=nmi_data.exp[keep],
+        )
+        file_name = f"{nmi_data.nmi}_usage_heatmap_{year}.html"
+        fig, _ = usage_heatmap(year_data)
+        fig = compact_figure(fig)
+        fig.write_html(output_dir / file_name, include_plotlyjs=src)
+        files[int(str(year))] = file_name
+    return files
 
-    fig = usage_heatmap(nmi)
-    file_path = output_dir / f"{nmi}_usage_heatmap.html"
-    fig.write_html(file_path, full_html=False, include_plotlyjs="cdn")
-    log.info("Created %s", file_path)
-    return file_path
+
+@timed
+def build_usage_heatmap(
+    nmi_data: NMIData, keep_fragments: bool = False, max_points: int = MAX_POINTS
+) -> str:
+    """Save heatmap of power usage
+
+    When the rows are resampled, the full resolution is saved as one page for
+    each year and linked below the chart.
+    """
+    nmi = nmi_data.nmi
+    fig, resolution = usage_heatmap(nmi_data, max_points)
+    html = figure_fragment(fig, f"{nmi}_usage_heatmap.html", keep_fragments)
+    if resolution != "day":
+        files = save_year_heatmaps(nmi_data)
+        links = " ".join(f'<a href="{x}">{year}</a>' for year, x in files.items())
+        html += f"<p>Full resolution by year: {links}</p>"
+    return html
 
 
 def copy_static_data():
-    """Copy static files"""
-    files = []
-    for file in files:
-        from_loc = template_dir / file
-        to_loc = output_dir / file
-        shutil.copy(from_loc, to_loc)
-
-
-def get_seasonal_data(nmi: str):
-    season_data = {}
-    all_exp = 0
-    all_imp = 0
-    total_days = 0
-    for row in get_season_data(nmi):
-        season = row["Season"]
-        num_days = row["num_days"]
-        imp = row["imp"]
-        exp = row["exp"]
-        all_imp += imp
-        all_exp += exp
-        total_days += num_days
-        season_data[season] = imp / num_days
-
-    season_data["EXPORT"] = all_exp / total_days
-    season_data["TOTAL"] = all_imp / total_days
+    """Copy the static files offline reports use"""
+    if env.globals["offline"]:
+        write_assets(output_dir)
+
+
+@timed
+def get_seasonal_data(summary: NMISummary):
+    seasons = summary.seasons
+    daily = seasons["imp"] / seasons["num_days"]
+    season_data = dict(zip(seasons["Season"], daily, strict=True))
+    total_days = seasons["num_days"].sum()
+    season_data["EXPORT"] = seasons["exp"].sum() / total_days
+    season_data["TOTAL"] = seasons["imp"].sum() / total_days
     return season_data
 
 
-def get_month_data(nmi: str):
-    sql = "SELECT * from monthly_reads where nmi = :nmi"
-    rows = []
-    for row in db.query(sql, {"nmi": nmi}):
-        del row["nmi"]
-        month_desc = row["month"]
-        num_days = row["num_days"]
-        year, month = (int(x) for x in month_desc.split("-"))
-        _, exp_num_days = monthrange(year, month)
-        incomplete = num_days < exp_num_days
-        if incomplete:
-            row["month"] = row["month"] + "*"
-        rows.append(row)
-    return rows
-
-
-def build_month_table(nmi: str):
-    file_path = output_dir / f"{nmi}_month_table.html"
-    data = get_month_data(nmi)
-    df = pl.DataFrame(data)
-    df = df.with_columns((pl.col("imp") - pl.col("exp")).alias("net"))
+@timed
+def build_month_table(summary: NMISummary, keep_fragments: bool = False) -> str:
+    df = summary.months.with_columns((pl.col("imp") - pl.col("exp")).alias("net"))
     df = df.with_columns((pl.col("net") / pl.col("num_days")).alias("net_daily"))
     table = GT(df)
     table = table.fmt_number(
@@ -374,75 +595,241 @@ def build_month_table(nmi: str):
         month="Month",
         num_days="# Days",
     )
-    table.write_raw_html(file_path)
-    log.info("Created %s", file_path)
-    return file_path
+    html = table.as_raw_html()
+    if keep_fragments:
+        save_fragment(html, f"{summary.nmi}_month_table.html")
+    return html
 
 
-def build_report(nmi: str, static_mode: bool = True):
-    template = env.get_template("nmi-report.html")
-    start, end = get_date_range(nmi)
-    fp_imp = build_daily_usage_chart(nmi, "import")
-    fp_exp = build_daily_usage_chart(nmi, "export")
+def get_tariffs() -> list[Tariff]:
+    """Tariffs in the data folder, or none if there is no file or it is invalid
 
-    build_daily_usage_chart(nmi, "total")
-    has_export = True if fp_exp else None
+    An invalid file is logged rather than raised, so the reports are still
+    built without their tariff comparison.
+    """
+    file_path = find_tariff_file(model.data_dir)
+    if file_path is None:
+        return []
+    try:
+        return load_tariffs(file_path)
+    except (OSError, ValueError, ImportError) as e:
+        log.warning("Skipping tariff comparison, unable to read %s: %s", file_path, e)
+        return []
 
-    month_table_fp = build_month_table(nmi)
-    with open(month_table_fp) as fh:
-        month_table = fh.read()
 
-    ch_daily_fp = build_daily_plot(nmi)
-    with open(ch_daily_fp) as fh:
-        daily_chart = fh.read()
+@timed
+def get_tariff_ranking(
+    nmi_data: NMIData, tariffs: list[Tariff], top: int = 10
+) -> list[dict] | None:
+    """Cheapest tariffs for an NMI, if there are any to compare"""
+    if not tariffs:
+        return None
+    engine = TariffEngine(tariffs)
+    return engine.rank(UsageGrid.from_nmi_data(nmi_data))[:top]
 
-    ch_tou_fp = build_usage_heatmap(nmi)
-    with open(ch_tou_fp) as fh:
-        tou_chart = fh.read()
 
-    profile_fp = build_day_profile_plot(nmi)
-    if profile_fp:
-        with open(profile_fp) as fh:
-            profile_chart = fh.read()
-    else:
-        profile_chart = ""
+@dataclass(frozen=True)
+class Stage:
+    """A step of a report, run once the stages it depends on are done"""
 
-    profiles_fp = build_days_profiles_plot(nmi)
-    with open(profiles_fp) as fh:
-        profiles_chart = fh.read()
+    func: Callable[[dict], Any]
+    deps: tuple[str, ...] = ()
+    main_thread: bool = False  # SQLite connections cannot move between threads
 
-    ldc_fp = build_load_duration_curve(nmi)
-    with open(ldc_fp) as fh:
-        ldc_chart = fh.read()
 
+SOURCE_STAGES = {
+    "nmi_data": Stage(lambda x: load_nmi_data(x["nmi"]), main_thread=True),
+    "summary": Stage(lambda x: load_summaries([x["nmi"]])[x["nmi"]], main_thread=True),
+}
+OUTPUT_STAGES = {
+    "calendars": Stage(
+        lambda x: build_calendar_charts(
+            x["nmi_data"], x["calendar"], x["keep_fragments"]
+        ),
+        ("nmi_data",),
+    ),
+    "month_table": Stage(
+        lambda x: build_month_table(x["summary"], x["keep_fragments"]), ("summary",)
+    ),
+    "daily": Stage(
+        lambda x: build_daily_plot(x["nmi_data"], x["keep_fragments"], x["max_points"]),
+        ("nmi_data",),
+    ),
+    "heatmap": Stage(
+        lambda x: build_usage_heatmap(
+            x["nmi_data"], x["keep_fragments"], x["max_points"]
+        ),
+        ("nmi_data",),
+    ),
+    "profile": Stage(
+        lambda x: build_day_profile_plot(x["nmi_data"], x["keep_fragments"]),
+        ("nmi_data",),
+    ),
+    "profiles": Stage(
+        lambda x: build_days_profiles_plot(
+            x["nmi_data"], x["profiles_mode"], x["keep_fragments"]
+        ),
+        ("nmi_data",),
+    ),
+    "ldc": Stage(
+        lambda x: build_load_duration_curve(
+            x["nmi_data"], x["compare_years"], x["keep_fragments"]
+        ),
+        ("nmi_data",),
+    ),
+    "seasons": Stage(lambda x: get_seasonal_data(x["summary"]), ("summary",)),
+    "tariffs": Stage(
+        lambda x: get_tariff_ranking(x["nmi_data"], x["tariff_list"]), ("nmi_data",)
+    ),
+}
+REPORT_STAGES = SOURCE_STAGES | OUTPUT_STAGES
+STAGE_THREADS = 4
+
+
+def run_stages(names: list[str], ctx: dict, threads: int = STAGE_THREADS) -> dict:
+    """Run stages and their dependencies, adding their outputs to ctx
+
+    Stages whose outputs are already in ctx are skipped. Independent stages
+    run concurrently on a thread pool, which overlaps file writes, PNG
+    encoding and numpy work that release the GIL.
+    """
+    pending = set()
+    stack = list(names)
+    while stack:
+        name = stack.pop()
+        if name not in ctx and name not in pending:
+            pending.add(name)
+            stack += REPORT_STAGES[name].deps
+
+    pool = ThreadPoolExecutor(threads) if threads > 1 else None
+    running = {}
+    try:
+        while pending or running:
+            ready = sorted(
+                x for x in pending if all(d in ctx for d in REPORT_STAGES[x].deps)
+            )
+            pending.difference_update(ready)
+            ready.sort(key=lambda x: REPORT_STAGES[x].main_thread)
+            for name in ready:
+                stage = REPORT_STAGES[name]
+                if pool is None or stage.main_thread:
+                    ctx[name] = stage.func(ctx)
+                else:
+                    running[pool.submit(stage.func, ctx)] = name
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    ctx[running.pop(future)] = future.result()
+            elif pending and not ready:
+                raise ValueError(f"Stages have unmet dependencies: {pending}")
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    return ctx
+
+
+def stage_cache_path(nmi: str) -> Path:
+    return output_dir / ".stages" / f"{nmi}.json"
+
+
+def load_stage_cache(nmi: str, inputs: dict) -> dict:
+    """Stage outputs saved by an earlier build with the same inputs"""
+    file_path = stage_cache_path(nmi)
+    if not file_path.exists():
+        return {}
+    with open(file_path, encoding="utf-8") as fh:
+        cached = json.load(fh)
+    return cached["stages"] if cached["inputs"] == inputs else {}
+
+
+def save_stage_cache(nmi: str, inputs: dict, stages: dict) -> None:
+    file_path = stage_cache_path(nmi)
+    file_path.parent.mkdir(exist_ok=True)
+    with open(file_path, "w", encoding="utf-8") as fh:
+        json.dump({"inputs": inputs, "stages": stages}, fh)
+
+
+def build_report(
+    nmi: str,
+    static_mode: bool = True,
+    profiles_mode: str = "lines",
+    compare_years: bool = False,
+    keep_fragments: bool = False,
+    calendar: str = "calplot",
+    max_points: int = MAX_POINTS,
+    summary: NMISummary | None = None,
+    stages: list[str] | None = None,
+    threads: int = STAGE_THREADS,
+    inputs: dict | None = None,
+    tariffs: list[Tariff] | None = None,
+):
+    """Render the report page for an NMI
+
+    With `stages`, only those stages are rerun and the others are taken from
+    the previous `stages` build of the report if its inputs are unchanged.
+    Only these builds save their stages, as the cache is several MB a report.
+
+    Pass the NMI's slice of `load_summaries`, its `get_report_inputs` and the
+    build's `get_tariffs` when building many reports, so they are not worked
+    out again for each one.
+    """
+    options = {
+        "static_mode": static_mode,
+        "profiles_mode": profiles_mode,
+        "compare_years": compare_years,
+        "keep_fragments": keep_fragments,
+        "calendar": calendar,
+        "max_points": max_points,
+    }
+    if inputs is None:
+        inputs = get_report_inputs(nmi, options, get_template_hash(), get_tariff_hash())
+    if tariffs is None:
+        tariffs = get_tariffs()
+    ctx = {"nmi": nmi, "tariff_list": tariffs, **options}
+    if summary is not None:
+        ctx["summary"] = summary
+    if stages is not None:
+        cached = load_stage_cache(nmi, inputs)
+        ctx |= {k: v for k, v in cached.items() if k not in stages}
+    run_stages(["summary", *OUTPUT_STAGES], ctx, threads)
+    if stages is not None:
+        save_stage_cache(nmi, inputs, {x: ctx[x] for x in OUTPUT_STAGES})
+
+    summary = ctx["summary"]
+    calendars = ctx["calendars"]
     report_data = {
         "static_mode": static_mode,
-        "start": start,
-        "end": end,
-        "has_export": has_export,
-        "daily_chart": daily_chart,
-        "tou_chart": tou_chart,
-        "profile_chart": profile_chart,
-        "profiles_chart": profiles_chart,
-        "ldc_chart": ldc_chart,
-        "imp_overview_chart": fp_imp.name,
-        "exp_overview_chart": fp_exp.name if has_export else None,
-        "season_data": get_seasonal_data(nmi),
-        "annual_data": get_annual_data(nmi),
-        "month_table": month_table,
+        "start": summary.start,
+        "end": summary.end,
+        "has_export": True if "export" in calendars else None,
+        "daily_chart": ctx["daily"],
+        "tou_chart": ctx["heatmap"],
+        "profile_chart": ctx["profile"],
+        "profiles_chart": ctx["profiles"],
+        "ldc_chart": ctx["ldc"],
+        "imp_overview_chart": calendars["import"],
+        "exp_overview_chart": calendars.get("export"),
+        "season_data": ctx["seasons"],
+        "annual_data": summary.annual,
+        "month_table": ctx["month_table"],
+        "tariff_ranking": ctx["tariffs"],
     }
 
-    output_html = template.render(nmi=nmi, **report_data)
+    template = env.get_template("nmi-report.html")
     file_path = output_dir / f"{nmi}.html"
-    with open(file_path, "w", encoding="utf-8") as fh:
-        fh.write(output_html)
+    with span("render_page", nmi):
+        template.stream(nmi=nmi, **report_data).dump(str(file_path), encoding="utf-8")
     logging.info("Created %s", file_path)
     return file_path
 
 
-def build_index(nmis: list[str]):
+def render_index(nmis: list[str]) -> str:
     template = env.get_template("index.html")
-    output_html = template.render(nmis=nmis)
+    return template.render(nmis=nmis)
+
+
+def build_index(nmis: list[str]):
+    output_html = render_index(nmis)
     file_path = output_dir / "index.html"
     with open(file_path, "w", encoding="utf-8") as fh:
         fh.write(output_html)
@@ -450,14 +837,251 @@ def build_index(nmis: list[str]):
     return file_path
 
 
-def build_reports():
-    if "daily_reads" not in db.table_names():
-        update_nem_database()
-    extend_sqlite(DB_PATH)
+def fleet_profile_fig(fleet: FleetSummary) -> go.Figure:
+    df = fleet.day_profile()
+    traces = [go.Scatter(x=df["time"], y=df["imp"], name="Import")]
+    if fleet.total_exp:
+        traces.append(go.Scatter(x=df["time"], y=df["exp"], name="Export"))
+    fig = go.Figure(data=traces)
+    for x in ["04:00", "09:00", "16:00", "21:00"]:
+        fig.add_vline(x=x, line_width=1, line_dash="dash", line_color="black")
+    fig.update_layout(
+        yaxis_title="Avg kW",
+        legend=dict(orientation="h", yanchor="top", y=1.02, xanchor="right", x=1),
+    )
+    fig.update_xaxes(dtick=6)
+    return fig
+
+
+def fleet_heatmap_fig(fleet: FleetSummary) -> go.Figure:
+    power = fleet.day_grid(fleet.imp) - fleet.day_grid(fleet.exp)
+    days = fleet.times[::SLOTS].astype("datetime64[D]")
+    times = fleet.day_profile()["time"]
+    has_export = bool(fleet.total_exp)
+    trace = go.Heatmap(
+        x=times,
+        y=days,
+        z=power.astype(np.float32),
+        coloraxis="coloraxis",
+        hoverongaps=False,
+    )
+    fig = go.Figure(data=trace)
+    fig.update_layout(
+        width=800,
+        height=200 + int(len(days) * 0.5),
+        margin=dict(l=20, r=20, t=20, b=20),
+        coloraxis=dict(
+            colorscale="Geyser" if has_export else "YlOrRd",
+            cmid=0.0 if has_export else None,
+            colorbar=dict(title="kW"),
+        ),
+    )
+    fig.update_yaxes(dtick="M1", tickformat="%b\n%Y", ticklabelmode="period")
+    fig.update_xaxes(dtick=6)
+    return fig
+
+
+@timed
+def render_portfolio(fleet: FleetSummary, top: int = 100) -> str:
+    """Render the fleet totals, charts and the NMIs using the most energy"""
+    template = env.get_template("portfolio.html")
+    return template.render(
+        fleet=fleet,
+        profile_chart=figure_fragment(
+            fleet_profile_fig(fleet), "portfolio_day_profile.html", False
+        ),
+        heatmap_chart=figure_fragment(
+            fleet_heatmap_fig(fleet), "portfolio_heatmap.html", False
+        ),
+        ranking=fleet.ranking(top),
+        top=top,
+    )
+
+
+def build_portfolio() -> Path:
+    file_path = output_dir / "portfolio.html"
+    with open(file_path, "w", encoding="utf-8") as fh:
+        fh.write(render_portfolio(load_fleet_summary()))
+    log.info("Created %s", file_path)
+    return file_path
+
+
+def try_build_report(
+    nmi: str, summary: NMISummary | None = None, inputs: dict | None = None, **kwargs
+) -> str | None:
+    """Build a report, logging any failure so other NMIs can still be built"""
+    try:
+        build_report(nmi, summary=summary, inputs=inputs, **kwargs)
+    except Exception:
+        log.exception("Unable to build report for %s", nmi)
+        return None
+    return nmi
+
+
+def profile_build_report(
+    nmi: str, summary: NMISummary | None = None, inputs: dict | None = None, **kwargs
+) -> tuple[str | None, list[dict]]:
+    """Build a report and return the timing spans recorded for it"""
+    enable()
+    try:
+        result = try_build_report(nmi, summary, inputs, **kwargs)
+    finally:
+        enable(False)
+    return result, take_spans()
+
+
+def cprofile_build_report(
+    build: Callable, nmi: str, summary: NMISummary | None, inputs: dict
+):
+    """Build a report under cProfile and save the stats next to it"""
+    profiler = cProfile.Profile()
+    result = profiler.runcall(build, nmi, summary, inputs)
+    file_path = output_dir / f"{nmi}.prof"
+    profiler.dump_stats(file_path)
+    log.info("Saved cProfile stats to %s", file_path)
+    return result
+
+
+def get_template_hash() -> str:
+    """Hash the contents of all report templates"""
+    digest = hashlib.sha256()
+    for file_path in sorted(template_dir.iterdir()):
+        digest.update(file_path.name.encode())
+        digest.update(file_path.read_bytes())
+    return digest.hexdigest()
+
+
+def get_tariff_hash() -> str | None:
+    """Hash the tariff file in the data folder, if there is one"""
+    return tariff_file_hash(find_tariff_file(model.data_dir))
+
+
+def get_report_inputs(
+    nmi: str, options: dict, template_hash: str, tariff_hash: str | None
+) -> dict:
+    """Everything a report page depends on, to tell when it must be rebuilt"""
+    return {
+        "data": get_nmi_fingerprint(nmi),
+        "version": __version__,
+        "templates": template_hash,
+        "offline": env.globals["offline"],
+        "tariffs": tariff_hash,
+        **options,
+    }
+
+
+def load_build_manifest() -> dict[str, dict]:
+    """Load the inputs each existing report was built from"""
+    file_path = output_dir / "manifest.json"
+    if not file_path.exists():
+        return {}
+    with open(file_path, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def save_build_manifest(manifest: dict[str, dict]) -> None:
+    file_path = output_dir / "manifest.json"
+    with open(file_path, "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+
+
+def build_reports(
+    jobs: int = 1,
+    force: bool = False,
+    only: list[str] | None = None,
+    profiles_mode: str = "lines",
+    compare_years: bool = False,
+    keep_fragments: bool = False,
+    calendar: str = "calplot",
+    max_points: int = MAX_POINTS,
+    profile: bool = False,
+    cprofile: str | None = None,
+    stages: list[str] | None = None,
+    threads: int = STAGE_THREADS,
+):
+    if stages is not None and set(stages) - set(OUTPUT_STAGES):
+        msg = f"Stages must be from {', '.join(OUTPUT_STAGES)}"
+        raise ValueError(msg)
+    db_path = update_nem_database(model.data_dir, jobs=jobs)
+    output_dir.mkdir(parents=True, exist_ok=True)
     copy_static_data()
-    nmis = get_nmis(DB_PATH)
-    for nmi in nmis:
-        build_report(nmi)
-    fp = Path(build_index(nmis)).resolve()
+    connect(db_path)
+    nmis = get_nmi_list()  # From nmi_extent, not a scan of every reading
+    manifest = {} if force else load_build_manifest()
+    manifest = {nmi: x for nmi, x in manifest.items() if nmi in nmis}
+    template_hash = get_template_hash()
+    tariff_hash = get_tariff_hash()
+    options = {
+        "static_mode": True,
+        "profiles_mode": profiles_mode,
+        "compare_years": compare_years,
+        "keep_fragments": keep_fragments,
+        "calendar": calendar,
+        "max_points": max_points,
+    }
+    inputs = {
+        nmi: get_report_inputs(nmi, options, template_hash, tariff_hash) for nmi in nmis
+    }
+    if cprofile:
+        only = [cprofile]
+    if only:
+        for nmi in set(only) - set(nmis):
+            log.warning("No data for NMI %s", nmi)
+        to_build = [nmi for nmi in nmis if nmi in only]
+    elif stages:
+        to_build = nmis  # Rerun the stages even if the inputs are unchanged
+    else:
+        to_build = [
+            nmi
+            for nmi in nmis
+            if manifest.get(nmi) != inputs[nmi]
+            or not (output_dir / f"{nmi}.html").exists()
+        ]
+    log.info("Skipping %s of %s reports", len(nmis) - len(to_build), len(nmis))
+
+    batch = load_summaries(to_build)
+    summaries = [batch.get(nmi) for nmi in to_build]
+    report_inputs = [inputs[nmi] for nmi in to_build]
+    build = partial(
+        profile_build_report if profile else try_build_report,
+        **options,
+        stages=stages,
+        threads=threads,
+        tariffs=get_tariffs(),
+    )
+    if cprofile:
+        cprofile_build = partial(cprofile_build_report, build)
+        results = list(map(cprofile_build, to_build, summaries, report_inputs))
+    elif jobs > 1:
+        # Polars and matplotlib hold threads and locks that do not survive fork
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            jobs,
+            mp_context=ctx,
+            initializer=configure,
+            initargs=(model.data_dir, output_dir, env.globals["offline"]),
+        ) as pool:
+            results = list(pool.map(build, to_build, summaries, report_inputs))
+    else:
+        results = list(map(build, to_build, summaries, report_inputs))
+    if profile:
+        records = [x for _, spans in results for x in spans]
+        results = [result for result, _ in results]
+        fp = write_profile(records, output_dir)
+        log.info("Saved stage timings to %s\n%s", fp, format_summary(records))
+    for nmi, result in zip(to_build, results, strict=True):
+        if result:
+            manifest[nmi] = inputs[nmi]
+        else:
+            manifest.pop(nmi, None)
+    num_failed = results.count(None)
+    if num_failed:
+        log.warning("Failed to build %s of %s reports", num_failed, len(to_build))
+    save_build_manifest(manifest)
+    if len(nmis) > 1 and (to_build or not (output_dir / "portfolio.html").exists()):
+        build_portfolio()
+    fp = Path(build_index([nmi for nmi in nmis if nmi in manifest])).resolve()
+    if env.globals["offline"]:
+        precompress(output_dir)
     webbrowser.open(fp.as_uri())
     return fp
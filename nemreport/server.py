@@ -0,0 +1,168 @@
+"""Serve the reports over HTTP, rendering each page when it is first opened"""
+
+import logging
+import threading
+import webbrowser
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from . import model, report
+from .model import connect, get_nmi_list
+from .portfolio import load_fleet_summary
+from .prepare_db import update_nem_database
+from .report import (
+    build_report,
+    copy_static_data,
+    get_report_inputs,
+    get_tariffs,
+    get_template_hash,
+    load_build_manifest,
+    render_index,
+    render_portfolio,
+    save_build_manifest,
+)
+from .tariffs import find_tariff_file, tariff_file_hash
+
+log = logging.getLogger(__name__)
+
+
+class ReportCache:
+    """Render report pages on demand and keep them until their inputs change
+
+    Pages are shared with `build` through the build manifest. Rendering and
+    database access are done one request at a time, as SQLite connections and
+    matplotlib are not safe to share between threads.
+    """
+
+    def __init__(self, **options):
+        self.options = {**options, "static_mode": False}
+        self.template_hash = get_template_hash()
+        self.tariff_stat = None
+        self.tariff_hash = None
+        self.tariffs = []
+        self.lock = threading.Lock()
+
+    def get_tariff_hash(self) -> str | None:
+        """Hash of the tariff file, only read again once the file changes"""
+        file_path = find_tariff_file(model.data_dir)
+        stat = file_path.stat() if file_path else None
+        key = (file_path, stat.st_mtime_ns, stat.st_size) if stat else None
+        if key != self.tariff_stat:
+            self.tariff_stat, self.tariff_hash = key, tariff_file_hash(file_path)
+            self.tariffs = get_tariffs()
+        return self.tariff_hash
+
+    def nmis(self) -> list[str]:
+        with self.lock:
+            connect()
+            return get_nmi_list()
+
+    def portfolio(self) -> str:
+        with self.lock:
+            connect()
+            return render_portfolio(load_fleet_summary())
+
+    def page(self, nmi: str) -> Path | None:
+        """Path to the current page for an NMI, rendering it if needed"""
+        with self.lock:
+            connect()
+            if nmi not in get_nmi_list():
+                return None
+            file_path = report.output_dir / f"{nmi}.html"
+            inputs = get_report_inputs(
+                nmi, self.options, self.template_hash, self.get_tariff_hash()
+            )
+            manifest = load_build_manifest()
+            if manifest.get(nmi) != inputs or not file_path.exists():
+                build_report(nmi, inputs=inputs, tariffs=self.tariffs, **self.options)
+                manifest[nmi] = inputs
+                save_build_manifest(manifest)
+            return file_path
+
+
+class ReportHandler(SimpleHTTPRequestHandler):
+    """Serve the NMI list and report pages, and files from the output folder"""
+
+    def __init__(self, *args, cache: ReportCache, **kwargs):
+        self.cache = cache
+        super().__init__(*args, directory=str(report.output_dir), **kwargs)
+
+    def do_GET(self):
+        path = self.path.split("?")[0].lstrip("/")
+        try:
+            if path in ("", "index.html"):
+                return self.send_page(render_index(self.cache.nmis()))
+            if path == "portfolio.html":
+                return self.send_page(self.cache.portfolio())
+            is_page = path.endswith(".html") and "/" not in path and "_" not in path
+            if is_page and self.cache.page(path.removesuffix(".html")) is None:
+                return self.send_error(HTTPStatus.NOT_FOUND, "No data for NMI")
+        except Exception:
+            log.exception("Unable to render %s", self.path)
+            return self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+        return super().do_GET()
+
+    def send_page(self, html: str):
+        body = html.encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        log.debug(fmt, *args)
+
+
+def try_update_database(data_dir: Path) -> None:
+    """Import new or changed NEM files, logging any failure"""
+    try:
+        update_nem_database(data_dir)
+    except Exception:
+        log.exception("Unable to update the database")
+
+
+def watch_data(data_dir: Path, interval: float, stop: threading.Event) -> None:
+    """Import new or changed NEM files until stopped"""
+    while not stop.wait(interval):
+        try_update_database(data_dir)
+
+
+def make_server(host: str, port: int, **options) -> ThreadingHTTPServer:
+    """Update the database and create a report server"""
+    update_nem_database(model.data_dir)
+    report.output_dir.mkdir(parents=True, exist_ok=True)
+    copy_static_data()
+    cache = ReportCache(**options)
+
+    def handler(*args, **kwargs):
+        return ReportHandler(*args, cache=cache, **kwargs)
+
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    watch_interval: float = 10.0,
+    open_browser: bool = False,
+    **options,
+) -> None:
+    """Serve the reports until interrupted"""
+    server = make_server(host, port, **options)
+    stop = threading.Event()
+    if watch_interval:
+        args = (model.data_dir, watch_interval, stop)
+        threading.Thread(target=watch_data, args=args, daemon=True).start()
+    url = f"http://{host}:{server.server_port}/"
+    log.info("Serving reports at %s", url)
+    if open_browser:
+        webbrowser.open(url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
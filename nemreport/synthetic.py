@@ -0,0 +1,124 @@
+"""Write synthetic NEM12 files for testing and benchmarking"""
+
+from datetime import date, timedelta
+from pathlib import Path
+
+import numpy as np
+
+INTERVALS = [5, 15, 30]
+
+
+def gap_mask(num_days: int, gap_fraction: float, rng: np.random.Generator):
+    """Mark runs of missing days, totalling roughly the given fraction"""
+    missing = np.zeros(num_days, dtype=bool)
+    target = int(num_days * gap_fraction)
+    while missing.sum() < target:
+        start = rng.integers(0, num_days)
+        missing[start : start + rng.integers(1, 15)] = True
+    return missing
+
+
+def household_power(
+    start: date,
+    num_days: int,
+    interval: int,
+    export: bool,
+    rng: np.random.Generator,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Import and export kWh for each day (rows) and interval (columns)
+
+    Load has morning and evening peaks that grow in summer and winter. With
+    export, a rooftop solar system offsets the load and exports any excess.
+    """
+    hours = (np.arange(1440 // interval) + 0.5) * interval / 60
+    doy = np.array(
+        [(start + timedelta(days=d)).timetuple().tm_yday for d in range(num_days)]
+    )
+    season = 1 + 0.3 * np.abs(np.cos(2 * np.pi * (doy[:, None] - 15) / 365))
+    shape = (
+        0.25
+        + 0.8 * np.exp(-(((hours - 7.5) / 1.0) ** 2))
+        + 1.5 * np.exp(-(((hours - 18.5) / 2.0) ** 2))
+    )
+    load = rng.uniform(0.6, 1.6) * season * shape
+    load *= rng.lognormal(0, 0.25, load.shape)
+
+    solar = np.zeros_like(load)
+    if export:
+        half_day = 6 + 1.2 * np.cos(2 * np.pi * (doy[:, None] - 355) / 365)
+        rise, sun_set = 12.5 - half_day, 12.5 + half_day
+        arc = np.clip((hours - rise) / (sun_set - rise), 0, 1)
+        clouds = rng.uniform(0.3, 1.0, (num_days, 1))
+        solar = rng.uniform(3, 8) * 0.75 * np.sin(np.pi * arc) * clouds
+
+    to_kwh = interval / 60
+    imp = np.maximum(load - solar, 0) * to_kwh
+    exp = np.maximum(solar - load, 0) * to_kwh
+    return imp, exp
+
+
+def write_nem12(
+    file_path: Path,
+    nmi: str,
+    start: date,
+    num_days: int,
+    interval: int = 30,
+    export: bool = True,
+    gap_fraction: float = 0.0,
+    seed: int = 0,
+) -> Path:
+    """Write a NEM12 file for one NMI with E1 (and B1) interval data"""
+    if interval not in INTERVALS:
+        msg = f"Interval must be one of {INTERVALS}"
+        raise ValueError(msg)
+    rng = np.random.default_rng(seed)
+    imp, exp = household_power(start, num_days, interval, export, rng)
+    missing = gap_mask(num_days, gap_fraction, rng)
+    channels = {"E1": imp, "B1": exp} if export else {"E1": imp}
+
+    with open(file_path, "w", newline="\n") as fh:
+        fh.write(f"100,NEM12,{start:%Y%m%d}0000,SYNTHMDP,SYNTHRTL\n")
+        for suffix, values in channels.items():
+            config = "".join(channels)
+            fh.write(
+                f"200,{nmi},{config},1,{suffix},N1,SYN{seed:05d},kWh,{interval},\n"
+            )
+            for d in np.flatnonzero(~missing):
+                day = start + timedelta(days=int(d))
+                reads = ",".join(f"{x:.3f}" for x in values[d])
+                fh.write(f"300,{day:%Y%m%d},{reads},A,,,{day:%Y%m%d}000000,\n")
+        fh.write("900\n")
+    return file_path
+
+
+def generate_nem12_files(
+    output_dir: Path,
+    num_nmis: int = 2,
+    years: float = 1.0,
+    interval: int = 30,
+    export: bool = True,
+    gap_fraction: float = 0.0,
+    seed: int = 0,
+    end: date = date(2024, 12, 31),
+) -> list[Path]:
+    """Write one synthetic NEM12 file per NMI, ending on the given day"""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    num_days = max(1, round(years * 365))
+    start = end - timedelta(days=num_days - 1)
+    files = []
+    for i in range(num_nmis):
+        nmi = f"SYN{i + 1:07d}"
+        file_path = output_dir / f"{nmi}.csv"
+        files.append(
+            write_nem12(
+                file_path,
+                nmi,
+                start,
+                num_days,
+                interval=interval,
+                export=export,
+                gap_fraction=gap_fraction,
+                seed=seed + i,
+            )
+        )
+    return files
@@ -0,0 +1,262 @@
+"""Compare electricity tariffs against interval data
+
+Tariffs are read from a JSON (or YAML, with the yaml extra) file holding a
+list of definitions such as:
+
+    {
+        "name": "Time of use",
+        "daily_charge": 1.1,
+        "rate": 0.25,
+        "windows": [
+            {"name": "Peak", "rate": 0.45, "start": "16:00", "end": "21:00"},
+            {"name": "Off peak", "rate": 0.18, "start": "22:00", "end": "07:00"}
+        ],
+        "demand": [{"rate": 0.30, "start": "16:00", "end": "21:00", "days": "weekday"}],
+        "feed_in": 0.05
+    }
+
+Import in an interval is charged at the first window that covers it, or at
+the flat `rate` otherwise. A tariff without a flat rate needs windows that
+cover every time of day, on every day of the year. Demand charges are per kW
+of the highest demand in their window each month.
+
+Savings are measured against the tariff marked `"current": true`, or against
+the median bill if none is.
+"""
+
+import hashlib
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Literal
+
+import numpy as np
+from pydantic import BaseModel, field_validator, model_validator
+
+from .model import NMIData
+from .prepare_db import SET_INTERVAL
+
+TARIFF_FILES = ["tariffs.json", "tariffs.yaml", "tariffs.yml"]
+SLOTS = 24 * 60 // SET_INTERVAL  # Intervals in a day
+DAY_TYPES = {"all": [0, 1], "weekday": [0], "weekend": [1]}
+
+
+class Period(BaseModel):
+    """Times of day, days of the week and months that a rate applies to"""
+
+    start: str = "00:00"
+    end: str = "24:00"
+    days: Literal["all", "weekday", "weekend"] = "all"
+    months: list[int] | None = None
+
+    @field_validator("start", "end")
+    @classmethod
+    def check_time(cls, value: str) -> str:
+        hours, minutes = (int(x) for x in value.split(":"))
+        if not 0 <= hours * 60 + minutes <= 24 * 60 or minutes % SET_INTERVAL:
+            msg = f"Must be a time from 00:00 to 24:00 in {SET_INTERVAL} min steps"
+            raise ValueError(msg)
+        return value
+
+    @field_validator("months")
+    @classmethod
+    def check_months(cls, value: list[int] | None) -> list[int] | None:
+        if value and not all(1 <= x <= 12 for x in value):
+            msg = "Months must be numbered from 1 (January) to 12 (December)"
+            raise ValueError(msg)
+        return value
+
+    @property
+    def key(self) -> tuple:
+        return (self.start, self.end, self.days, tuple(self.months or []))
+
+
+class Window(Period):
+    name: str = ""
+    rate: float
+
+
+class DemandCharge(Period):
+    rate: float  # $ per kW per month
+
+
+class Tariff(BaseModel):
+    name: str
+    daily_charge: float = 0.0
+    rate: float | None = None
+    windows: list[Window] = []
+    demand: list[DemandCharge] = []
+    feed_in: float = 0.0
+    current: bool = False
+
+    @model_validator(mode="after")
+    def check_rates(self):
+        if self.rate is None and not self.windows:
+            msg = "A tariff needs a flat rate or time of use windows"
+            raise ValueError(msg)
+        if self.rate is None:
+            covered = np.logical_or.reduce([period_mask(x) for x in self.windows])
+            if not covered.all():
+                msg = "Without a flat rate, the windows must cover every time"
+                raise ValueError(msg)
+        return self
+
+
+def slot_of(time: str) -> int:
+    hours, minutes = (int(x) for x in time.split(":"))
+    return (hours * 60 + minutes) // SET_INTERVAL
+
+
+def period_mask(period: Period) -> np.ndarray:
+    """Which (month, day type, slot) cells a period covers"""
+    start, end = slot_of(period.start), slot_of(period.end)
+    slots = np.arange(SLOTS)
+    if start < end:
+        in_time = (slots >= start) & (slots < end)
+    else:  # Wraps past midnight, or covers the whole day if start == end
+        in_time = (slots >= start) | (slots < end)
+    months = np.zeros(12, dtype=bool)
+    months[[x - 1 for x in period.months] if period.months else slice(None)] = True
+    day_types = np.zeros(2, dtype=bool)
+    day_types[DAY_TYPES[period.days]] = True
+    return months[:, None, None] & day_types[None, :, None] & in_time[None, None, :]
+
+
+@dataclass
+class UsageGrid:
+    """Interval data for an NMI summed into the cells tariffs are defined on"""
+
+    nmi: str
+    num_days: int
+    imp: np.ndarray  # kWh by (month, day type, slot)
+    exp_total: float
+    peaks: np.ndarray  # Highest kW by (billing month, month, day type, slot)
+
+    @classmethod
+    def from_nmi_data(cls, nmi_data: NMIData, days: int = 365) -> "UsageGrid":
+        """Summarise the most recent `days` of interval data"""
+        t_start = nmi_data.t_start
+        keep = (
+            t_start >= t_start[-1] - np.timedelta64(days, "D") if len(t_start) else []
+        )
+        t_start = t_start[keep]
+        imp, exp = nmi_data.imp[keep], nmi_data.exp[keep]
+
+        day = t_start.astype("datetime64[D]")
+        month = t_start.astype("datetime64[M]")
+        month_num = month.astype(int) % 12
+        day_type = (((day.astype(int) + 3) % 7) >= 5).astype(int)  # 1970-01-01 = Thu
+        slot = ((t_start - day) // np.timedelta64(SET_INTERVAL, "m")).astype(int)
+        cell = (month_num * 2 + day_type) * SLOTS + slot
+        grid = np.bincount(cell, weights=imp, minlength=12 * 2 * SLOTS)
+
+        billing, billing_idx = np.unique(month, return_inverse=True)
+        peaks = np.zeros((len(billing), 12 * 2 * SLOTS))
+        kw = imp * 60 / SET_INTERVAL
+        np.maximum.at(peaks, (billing_idx, cell), kw)
+        return cls(
+            nmi=nmi_data.nmi,
+            num_days=len(np.unique(day)),
+            imp=grid.reshape(12, 2, SLOTS),
+            exp_total=float(exp.sum()),
+            peaks=peaks.reshape(len(billing), 12, 2, SLOTS),
+        )
+
+
+class TariffEngine:
+    """Evaluate many tariffs, reusing the masks of periods they share"""
+
+    def __init__(self, tariffs: list[Tariff]):
+        self.tariffs = tariffs
+        self.masks: dict[tuple, np.ndarray] = {}
+        current = [x.name for x in tariffs if x.current]
+        self.baseline = current[0] if current else "median"
+
+    def mask(self, period: Period) -> np.ndarray:
+        if period.key not in self.masks:
+            self.masks[period.key] = period_mask(period)
+        return self.masks[period.key]
+
+    def bill(self, tariff: Tariff, usage: UsageGrid) -> dict:
+        """Cost of a tariff for the period of the usage grid"""
+        unassigned = np.ones_like(usage.imp, dtype=bool)
+        energy = 0.0
+        for window in tariff.windows:
+            cells = self.mask(window) & unassigned
+            energy += window.rate * usage.imp[cells].sum()
+            unassigned &= ~cells
+        energy += (tariff.rate or 0.0) * usage.imp[unassigned].sum()
+        demand = sum(
+            x.rate * usage.peaks[:, self.mask(x)].max(axis=1, initial=0).sum()
+            for x in tariff.demand
+        )
+        supply = tariff.daily_charge * usage.num_days
+        feed_in = tariff.feed_in * usage.exp_total
+        total = supply + energy + demand - feed_in
+        annual = total * 365 / usage.num_days if usage.num_days else 0.0
+        return {
+            "nmi": usage.nmi,
+            "tariff": tariff.name,
+            "days": usage.num_days,
+            "supply": round(supply, 2),
+            "energy": round(float(energy), 2),
+            "demand": round(float(demand), 2),
+            "feed_in": round(feed_in, 2),
+            "total": round(float(total), 2),
+            "annual": round(float(annual), 2),
+        }
+
+    def rank(self, usage: UsageGrid) -> list[dict]:
+        """Bills for every tariff, cheapest first, with the saving against the
+        current tariff or the median bill
+        """
+        bills = sorted(
+            (self.bill(x, usage) for x in self.tariffs), key=lambda x: x["annual"]
+        )
+        annuals = {x["tariff"]: x["annual"] for x in bills}
+        if self.baseline in annuals:
+            base = annuals[self.baseline]
+        else:
+            base = float(np.median(list(annuals.values()))) if annuals else 0.0
+        for i, row in enumerate(bills, start=1):
+            row["rank"] = i
+            row["saving"] = round(base - row["annual"], 2)
+            row["saving_vs"] = self.baseline
+        return bills
+
+
+def find_tariff_file(data_dir: Path) -> Path | None:
+    """The tariff definitions in the data folder, if there are any"""
+    for name in TARIFF_FILES:
+        if (data_dir / name).exists():
+            return data_dir / name
+    return None
+
+
+def tariff_file_hash(file_path: Path | None) -> str | None:
+    if file_path is None:
+        return None
+    return hashlib.sha256(file_path.read_bytes()).hexdigest()[:16]
+
+
+def load_tariffs(file_path: Path) -> list[Tariff]:
+    """Read a list of tariff definitions from a JSON or YAML file"""
+    text = file_path.read_text()
+    if file_path.suffix in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError as e:
+            msg = "Install nemreport[yaml] to read YAML tariff files, or use JSON"
+            raise ImportError(msg) from e
+        try:
+            data = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ValueError(f"Invalid YAML in {file_path}: {e}") from e
+    else:
+        data = json.loads(text)
+    if isinstance(data, dict):
+        data = data["tariffs"]
+    tariffs = [Tariff.model_validate(x) for x in data]
+    if sum(x.current for x in tariffs) > 1:
+        raise ValueError(f"Only one tariff in {file_path} can be marked current")
+    return tariffs
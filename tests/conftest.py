@@ -0,0 +1,21 @@
+from pathlib import Path
+
+import pytest
+
+from nemreport.model import connect, get_nmi_list
+from nemreport.prepare_db import DEFAULT_DIR, get_nem_files, update_nem_database
+from nemreport.synthetic import generate_nem12_files
+
+
+@pytest.fixture(scope="session", autouse=True)
+def nem_files() -> list[Path]:
+    """Use synthetic NEM12 files when no real ones are in the data folder"""
+    files = get_nem_files(DEFAULT_DIR) if DEFAULT_DIR.exists() else []
+    return files or generate_nem12_files(DEFAULT_DIR, num_nmis=2, years=1.1)
+
+
+@pytest.fixture(scope="session")
+def first_nmi(nem_files) -> str:
+    """The first NMI in the data folder, whether real or synthetic"""
+    connect(update_nem_database(DEFAULT_DIR))
+    return get_nmi_list()[0]
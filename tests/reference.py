@@ -0,0 +1,94 @@
+"""Straightforward per-NMI queries the optimised data access is checked against"""
+
+from datetime import datetime
+
+import pandas as pd
+from dateutil.parser import isoparse
+
+from nemreport.model import (
+    MONTH_SEASONS,
+    flag_incomplete_months,
+    get_db,
+    get_interval_arrays,
+    pivot_day_profile,
+    query_frame,
+)
+
+# Import less export for each interval, summed across channels
+COMBINED_READINGS = """
+WITH combined AS (
+SELECT nmi, t_start, MAX(t_end) AS t_end,
+SUM(CASE WHEN substr(channel,1,1) = 'B' THEN -1 * value ELSE value END) AS value
+FROM readings WHERE nmi = :nmi
+GROUP BY nmi, t_start
+)
+"""
+
+
+def get_date_range(nmi: str) -> tuple[datetime, datetime]:
+    sql = "SELECT MIN(t_start), MAX(t_end) FROM readings WHERE nmi = :nmi"
+    start, end = get_db().execute(sql, {"nmi": nmi}).fetchone()
+    return isoparse(start), isoparse(end)
+
+
+def get_usage_df(nmi: str) -> pd.DataFrame:
+    t_start, imp, exp = get_interval_arrays(nmi)
+    return pd.DataFrame(
+        data={"consumption": imp, "export": -exp},
+        index=pd.DatetimeIndex(t_start),
+    )
+
+
+def get_season_data(nmi: str) -> list[dict]:
+    sql = "SELECT * FROM latest_year_seasons WHERE nmi = :nmi"
+    return list(get_db().query(sql, {"nmi": nmi}))
+
+
+def get_annual_data(nmi: str) -> dict:
+    sql = "SELECT * FROM latest_year WHERE nmi = :nmi"
+    return next(get_db().query(sql, {"nmi": nmi}))
+
+
+def get_month_data(nmi: str) -> list[dict]:
+    df = flag_incomplete_months(query_frame("SELECT * FROM monthly_reads", [nmi]))
+    return df.drop("nmi").to_dicts()
+
+
+def get_day_profile(nmi: str) -> pd.DataFrame:
+    sql = f"""{COMBINED_READINGS}
+    SELECT
+        CAST(strftime('%m', cr.t_start) AS INTEGER) AS month,
+        strftime('%H:%M', cr.t_start) AS time,
+        SUM(cr.value) AS total,
+        COUNT(*) AS num
+    FROM combined cr
+    WHERE cr.t_start >= (
+        SELECT DATETIME(last_interval, '-366 days') FROM nmi_extent
+        WHERE nmi = :nmi
+    )
+    GROUP BY month, time
+    """
+    df = pd.DataFrame(get_db().query(sql, {"nmi": nmi}))
+    df["season"] = MONTH_SEASONS[df["month"] - 1]
+    return pivot_day_profile(df)
+
+
+def get_day_profiles(nmi: str) -> pd.DataFrame:
+    sql = f"""{COMBINED_READINGS}
+    SELECT
+        strftime('%Y-%m-%d', cr.t_start) AS day,
+        strftime('%H:%M', cr.t_start) AS time,
+        AVG(cr.value) * 12 AS value
+    FROM combined cr
+    LEFT JOIN nmi_extent li ON li.nmi = cr.nmi
+    WHERE cr.t_start >= DATETIME(li.last_interval, '-366 days')
+    GROUP BY day, time
+    """
+    rows = list(get_db().query(sql, {"nmi": nmi}))
+    return pd.DataFrame(
+        data={
+            "day": [x["day"] for x in rows],
+            "time": [x["time"] for x in rows],
+            "Avg kW": [x["value"] for x in rows],
+        }
+    )
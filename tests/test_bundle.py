@@ -0,0 +1,34 @@
+import gzip
+
+from nemreport import bundle
+from nemreport.bundle import PLOTLY_JS, STYLESHEET, precompress, write_assets
+
+
+def test_write_assets(tmp_path, monkeypatch):
+    monkeypatch.setattr(bundle, "download", lambda url: b"body { margin: 0 }")
+    write_assets(tmp_path)
+
+    assert (tmp_path / PLOTLY_JS).stat().st_size > 1_000_000
+    assert (tmp_path / STYLESHEET).read_bytes() == b"body { margin: 0 }"
+
+
+def test_write_assets_no_network(tmp_path, monkeypatch, caplog):
+    def offline(url):
+        raise OSError("No network")
+
+    monkeypatch.setattr(bundle, "download", offline)
+    write_assets(tmp_path)
+
+    assert not (tmp_path / STYLESHEET).exists()
+    assert "Unable to download" in caplog.text
+
+
+def test_precompress(tmp_path):
+    page = tmp_path / "page.html"
+    page.write_text("<p>kWh</p>" * 100)
+
+    written = precompress(tmp_path)
+    assert tmp_path / "page.html.gz" in written
+    gz_data = (tmp_path / "page.html.gz").read_bytes()
+    assert gzip.decompress(gz_data) == page.read_bytes()
+    assert precompress(tmp_path) == []  # Unchanged files are skipped
@@ -1,6 +1,13 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
 import pytest
+from sqlite_utils import Database
 from typer.testing import CliRunner
 
+from nemreport import bundle, report
 from nemreport.cli import app
 
 
@@ -15,13 +22,186 @@ def test_cli_version(runner):
     assert result.exit_code == 0
 
 
+def test_cli_import_time():
+    """The CLI should start quickly by not importing the heavy libraries"""
+    code = (
+        "import sys, time; t = time.perf_counter(); import nemreport.cli; "
+        "print(time.perf_counter() - t); "
+        "print(any(x in sys.modules for x in ['pandas', 'polars', 'plotly']))"
+    )
+    res = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    elapsed, heavy = res.stdout.split()
+    assert heavy == "False"
+    assert float(elapsed) < 0.5
+
+
+def test_cli_check_db_data_dir(runner, tmp_path):
+    result = runner.invoke(app, ["--data-dir", str(tmp_path), "check-db"])
+
+    assert result.exit_code == 1
+    assert "Missing" in result.stdout
+
+
+def test_cli_generate(runner, tmp_path):
+    result = runner.invoke(
+        app, ["--data-dir", str(tmp_path), "generate", "--nmis", "3", "--years", "0.1"]
+    )
+
+    assert result.exit_code == 0
+    assert len(list(tmp_path.glob("*.csv"))) == 3
+
+
 def test_cli_db_update(runner):
     result = runner.invoke(app, ["update-db"])
     assert "nemdata.db" in result.stdout
     assert result.exit_code == 0
 
 
+def test_cli_db_update_full(runner):
+    result = runner.invoke(app, ["update-db", "--full"])
+    assert "nemdata.db" in result.stdout
+    assert result.exit_code == 0
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_cli_db_update_jobs(runner, tmp_path, jobs):
+    runner.invoke(app, ["--data-dir", str(tmp_path), "generate", "--years", "0.05"])
+    (tmp_path / "bad.csv").write_text("100,NEM12,200301011534,MDP1,RETAILER1\n300,x\n")
+    result = runner.invoke(
+        app, ["--data-dir", str(tmp_path), "update-db", "--jobs", jobs]
+    )
+
+    assert result.exit_code == 0
+    db = Database(tmp_path / "nemdata.db")
+    assert db["readings"].count == 2 * 2 * 18 * 288
+    assert sorted(x["path"] for x in db["ingest_manifest"].rows) == [
+        "SYN0000001.csv",
+        "SYN0000002.csv",
+    ]
+
+
+def test_cli_check_db(runner):
+    result = runner.invoke(app, ["check-db"])
+    assert "All expected indexes exist" in result.stdout
+    assert result.exit_code == 0
+
+
 def test_cli_build(runner):
     result = runner.invoke(app, ["build"])
 
     assert result.exit_code == 0
+
+
+def test_cli_build_parallel(runner):
+    result = runner.invoke(app, ["build", "--jobs", "2", "--force"])
+
+    assert result.exit_code == 0
+
+
+def test_cli_build_only(runner):
+    result = runner.invoke(app, ["build", "--only", "NOTANMI"])
+
+    assert result.exit_code == 0
+
+
+def test_cli_build_options(runner):
+    result = runner.invoke(app, ["build", "--profiles", "bands", "--compare-years"])
+
+    assert result.exit_code == 0
+
+
+def test_cli_build_keep_fragments(runner):
+    result = runner.invoke(app, ["build", "--force", "--keep-fragments"])
+
+    assert result.exit_code == 0
+    assert list(Path("output").glob("*_usage_heatmap.html"))
+
+
+def test_cli_build_plotly_calendar(runner):
+    result = runner.invoke(app, ["build", "--force", "--calendar", "plotly"])
+
+    assert result.exit_code == 0
+
+
+def test_cli_build_bad_calendar(runner):
+    result = runner.invoke(app, ["build", "--calendar", "nope"])
+
+    assert result.exit_code != 0
+
+
+def test_cli_build_stages(runner):
+    result = runner.invoke(app, ["build", "--stages", "heatmap,ldc", "--threads", "2"])
+
+    assert result.exit_code == 0
+
+
+def test_cli_build_bad_stages(runner):
+    result = runner.invoke(app, ["build", "--stages", "heatmap,nope"])
+
+    assert result.exit_code != 0
+
+
+def test_cli_build_output_dir(runner, tmp_path, first_nmi):
+    out_dir = tmp_path / "reports"
+    result = runner.invoke(
+        app, ["--output-dir", str(out_dir), "build", "--only", first_nmi]
+    )
+
+    assert result.exit_code == 0
+    assert (out_dir / f"{first_nmi}.html").exists()
+
+
+def test_cli_build_offline(runner, tmp_path, monkeypatch, first_nmi):
+    monkeypatch.setitem(report.env.globals, "offline", False)  # Restored after
+    monkeypatch.setattr(bundle, "download", lambda url: b"body { margin: 0 }")
+    out_dir = tmp_path / "reports"
+    args = ["--output-dir", str(out_dir), "build", "--only", first_nmi]
+    result = runner.invoke(app, [*args, "--offline"])
+
+    assert result.exit_code == 0
+    html = (out_dir / f"{first_nmi}.html").read_text(encoding="utf-8")
+    assert html.count("assets/plotly-") == 1
+    assert "cdn.plot.ly" not in html
+    assert list((out_dir / "assets").glob("plotly-*.min.js"))
+    assert (out_dir / "assets" / "water.css").exists()
+    assert (out_dir / f"{first_nmi}.html.gz").exists()
+
+
+def test_cli_build_profile(runner):
+    result = runner.invoke(app, ["build", "--force", "--profile"])
+
+    assert result.exit_code == 0
+    assert Path("output/profile.json").exists()
+    assert Path("output/profile.csv").exists()
+
+
+def test_cli_build_cprofile(runner, first_nmi):
+    result = runner.invoke(app, ["build", "--cprofile", first_nmi])
+
+    assert result.exit_code == 0
+    assert Path(f"output/{first_nmi}.prof").exists()
+
+
+def test_cli_query(runner, first_nmi):
+    result = runner.invoke(
+        app, ["query", first_nmi, "-r", "month", "--start", "2024-01-01"]
+    )
+
+    assert result.exit_code == 0
+    assert result.stdout.startswith("period,imp,exp,")
+    assert "2024-01," in result.stdout
+
+
+def test_cli_query_json(runner, first_nmi):
+    result = runner.invoke(app, ["query", first_nmi, "--format", "json"])
+
+    assert result.exit_code == 0
+    assert json.loads(result.stdout)[0]["imp_morning"] >= 0
+
+
+def test_cli_query_bad_resolution(runner, first_nmi):
+    result = runner.invoke(app, ["query", first_nmi, "-r", "fortnight"])
+
+    assert result.exit_code != 0
@@ -0,0 +1,208 @@
+import numpy as np
+import pandas as pd
+import polars as pl
+import pytest
+from nemreader.output_db import get_nmi_channels, get_nmi_readings, get_nmis
+from sqlite_utils import Database
+
+from nemreport.model import (
+    choose_rollup,
+    connect,
+    duration_curve,
+    flag_incomplete_months,
+    get_cached_interval_arrays,
+    get_interval_arrays,
+    get_nmi_fingerprint,
+    load_nmi_data,
+    load_summaries,
+    pivot_day_profile,
+    query_usage,
+)
+from nemreport.prepare_db import update_nem_database
+from nemreport.synthetic import generate_nem12_files
+
+from .reference import (
+    get_annual_data,
+    get_date_range,
+    get_day_profile,
+    get_day_profiles,
+    get_month_data,
+    get_season_data,
+    get_usage_df,
+)
+
+
+@pytest.fixture(scope="module")
+def db_path():
+    db_path = update_nem_database()
+    connect(db_path)
+    return db_path
+
+
+@pytest.fixture(scope="module")
+def nmi(db_path):
+    return get_nmis(db_path)[0]
+
+
+def test_get_usage_df(db_path, nmi):
+    df = get_usage_df(nmi)
+    assert df.index.is_monotonic_increasing
+    imp, exp = 0.0, 0.0
+    for ch in get_nmi_channels(db_path, nmi):
+        total = sum(x.value for x in get_nmi_readings(db_path, nmi, ch))
+        if ch.startswith("B"):
+            exp -= total
+        else:
+            imp += total
+    assert df["consumption"].sum() == pytest.approx(imp)
+    assert df["export"].sum() == pytest.approx(exp)
+
+
+def test_cached_interval_arrays(nmi, tmp_path):
+    expected = get_interval_arrays(nmi)
+    for _ in range(2):
+        result = get_cached_interval_arrays(nmi, cache_dir=tmp_path)
+        for x, y in zip(result, expected, strict=True):
+            np.testing.assert_array_equal(x, y)
+    assert len(list(tmp_path.glob(f"{nmi}_*.arrow"))) == 1
+
+
+def test_fingerprint_revised_reads(db_path, tmp_path):
+    generate_nem12_files(tmp_path, num_nmis=1, years=0.1, seed=0)
+    connect(update_nem_database(tmp_path))
+    before = get_nmi_fingerprint("SYN0000001")
+    generate_nem12_files(tmp_path, num_nmis=1, years=0.1, seed=1)  # Same dates
+    connect(update_nem_database(tmp_path))
+    after = get_nmi_fingerprint("SYN0000001")
+    connect(db_path)
+
+    assert before != after
+
+
+def test_drop_obsolete_tables(db_path, tmp_path):
+    generate_nem12_files(tmp_path, num_nmis=1, years=0.1)
+    new_path = update_nem_database(tmp_path)
+    Database(new_path)["combined_readings"].create({"nmi": str, "value": float})
+    update_nem_database(tmp_path)
+
+    assert "combined_readings" not in Database(new_path).table_names()
+
+
+def test_load_nmi_data(nmi):
+    nmi_data = load_nmi_data(nmi)
+    assert (nmi_data.start, nmi_data.end) == get_date_range(nmi)
+    pd.testing.assert_frame_equal(nmi_data.usage_df(), get_usage_df(nmi))
+
+
+def test_nmi_data_profiles(nmi):
+    nmi_data = load_nmi_data(nmi)
+    pd.testing.assert_frame_equal(nmi_data.day_profile(), get_day_profile(nmi))
+    pd.testing.assert_frame_equal(nmi_data.day_profiles(), get_day_profiles(nmi))
+
+
+def test_pivot_day_profile_missing_intervals():
+    df = pd.DataFrame(
+        {
+            "season": ["SUMMER", "SUMMER", "WINTER"],
+            "time": ["00:00", "00:05", "00:05"],
+            "total": [1.0, 2.0, 3.0],
+            "num": [1, 1, 1],
+        }
+    )
+    result = pivot_day_profile(df)
+    assert list(result.columns) == ["time", "Avg kW", "SUMMER", "WINTER"]
+    assert pd.isna(result.loc[0, "WINTER"])
+    assert result.loc[1, "Avg kW"] == pytest.approx(2.5 * 12)
+
+
+def test_usage_matrix(nmi):
+    nmi_data = load_nmi_data(nmi)
+    days, times, power = nmi_data.usage_matrix()
+    assert power.shape == (len(days), 96)
+    assert times[4] == "01:00"
+    df = nmi_data.usage_df()
+    first_slot = df[df.index < df.index[0] + pd.Timedelta(minutes=15)]
+    assert power[0, 0] == pytest.approx(first_slot.sum(axis=1).mean() * 12)
+
+
+def test_day_profile_bands(nmi):
+    nmi_data = load_nmi_data(nmi)
+    bands = nmi_data.day_profile_bands()
+    assert list(bands["time"]) == list(nmi_data.day_profile()["time"])
+    assert (bands["p10"] <= bands["p50"]).all()
+    assert (bands["p50"] <= bands["p90"]).all()
+
+
+def test_duration_curve():
+    values = np.arange(10_000, dtype=float)
+    fraction, curve = duration_curve(values, num_points=100)
+    assert len(fraction) == len(curve) == 101
+    assert (curve[0], curve[-1]) == (values.max(), values.min())
+    assert (np.diff(curve) <= 0).all()
+
+
+def test_rollups(db_path, nmi):
+    db = connect(db_path)
+    daily = db.execute(
+        "SELECT SUM(imp), SUM(exp), SUM(imp_night) FROM daily_reads WHERE nmi = ?",
+        [nmi],
+    ).fetchone()
+    for table in ["rollup_30min", "rollup_hour", "rollup_day", "rollup_month"]:
+        sql = f"SELECT SUM(imp), SUM(exp), SUM(imp_night) FROM {table} WHERE nmi = ?"
+        totals = db.execute(sql, [nmi]).fetchone()
+        assert totals == pytest.approx(daily)
+
+
+def test_choose_rollup():
+    assert choose_rollup("year") == ("rollup_month", None, None)
+    assert choose_rollup("month", "2024-01-01", "2024-03-01") == (
+        "rollup_month",
+        "2024-01",
+        "2024-03",
+    )
+    assert choose_rollup("month", "2024-01-15")[0] == "rollup_day"
+    assert choose_rollup("day", "2024-01-15T12:00")[0] == "rollup_hour"
+    assert choose_rollup("hour", None, "2024-01-15T12:30")[0] == "rollup_30min"
+    with pytest.raises(ValueError):
+        choose_rollup("hour", "2024-01-15T12:05")
+    with pytest.raises(ValueError):
+        choose_rollup("fortnight")
+
+
+def test_query_usage(db_path, nmi):
+    start, end = get_date_range(nmi)
+    first = f"{start:%Y-%m-%d}T12:00"
+    last = f"{end:%Y-%m}-01"
+    hours = query_usage(nmi, "hour", first, last)
+    for resolution in ["day", "week", "month", "year"]:
+        rows = query_usage(nmi, resolution, first, last)
+        assert sum(x["imp"] for x in rows) == pytest.approx(
+            sum(x["imp"] for x in hours)
+        )
+    weeks = query_usage(nmi, "week")
+    assert all(pd.Timestamp(x["period"]).dayofweek == 0 for x in weeks)
+
+
+def test_load_summaries(db_path, nmi):
+    summaries = load_summaries()
+    summary = summaries[nmi]
+
+    assert set(summaries) == set(get_nmis(db_path))
+    assert (summary.start, summary.end) == get_date_range(nmi)
+    assert summary.annual == get_annual_data(nmi)
+    assert summary.seasons.to_dicts() == [
+        {k: v for k, v in x.items() if k != "nmi"} for x in get_season_data(nmi)
+    ]
+    assert summary.months.to_dicts() == get_month_data(nmi)
+    assert list(load_summaries([nmi, "NOTANMI"])) == [nmi]
+
+
+def test_flag_incomplete_months():
+    months = ["2024-01", "2024-02", "2023-02"]
+    df = pl.DataFrame({"month": months, "num_days": [31, 28, 28]})
+
+    assert flag_incomplete_months(df)["month"].to_list() == [
+        "2024-01",
+        "2024-02*",
+        "2023-02",
+    ]
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from nemreader.output_db import get_nmis
+from sqlite_utils import Database
+
+from nemreport import report
+from nemreport.model import connect, load_summaries
+from nemreport.portfolio import SLOTS, load_fleet_summary
+from nemreport.prepare_db import update_nem_database
+
+
+@pytest.fixture(scope="module")
+def fleet():
+    db_path = update_nem_database()
+    connect(db_path)
+    return load_fleet_summary()
+
+
+def test_fleet_totals(fleet):
+    assert len(fleet.nmis) == len(load_summaries())
+    assert fleet.total_imp == pytest.approx(sum(x["imp"] for x in fleet.nmis))
+    assert fleet.total_exp == pytest.approx(sum(x["exp"] for x in fleet.nmis))
+    assert fleet.reporting.max() <= len(fleet.nmis)
+
+
+def test_coincident_peak(fleet):
+    peaks = [x["peak_kw"] for x in fleet.nmis]
+
+    assert max(peaks) <= fleet.peak_kw <= sum(peaks)
+    assert fleet.diversity_factor >= 1
+    assert fleet.peak_time is not None
+
+
+def test_day_profile(fleet):
+    df = fleet.day_profile()
+
+    assert len(df) == SLOTS
+    assert df["imp"].mean() * 24 == pytest.approx(
+        np.nanmean(fleet.day_grid(fleet.imp).sum(axis=1)) / 2
+    )
+
+
+def test_ranking(fleet):
+    ranking = fleet.ranking(1)
+
+    assert len(ranking) == 1
+    assert ranking[0]["imp"] == max(x["imp"] for x in fleet.nmis)
+
+
+def test_empty_fleet(tmp_path):
+    db_path = tmp_path / "empty.db"
+    Database(db_path)["nmi_extent"].create({"nmi": str, "last_interval": str})
+    connect(db_path)
+    try:
+        fleet = load_fleet_summary()
+        assert fleet.nmis == []
+        assert fleet.peak_kw == 0
+    finally:
+        connect(update_nem_database())
+
+
+def test_build_portfolio(fleet):
+    report.output_dir.mkdir(exist_ok=True)
+    html = report.build_portfolio().read_text(encoding="utf-8")
+
+    assert "Coincident peak" in html
+    assert f"{get_nmis(update_nem_database())[0]}.html" in html
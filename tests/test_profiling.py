@@ -0,0 +1,37 @@
+from nemreport import profiling
+
+
+@profiling.timed
+def get_rows(nmi: str) -> list[int]:
+    return [1, 2, 3]
+
+
+def test_timed_spans(tmp_path):
+    get_rows("NMI0000009")
+    assert profiling.take_spans() == []
+
+    profiling.enable()
+    try:
+        with profiling.span("page", "NMI0000009") as record:
+            record["bytes"] = len("<html>")
+        get_rows("NMI0000009")
+    finally:
+        profiling.enable(False)
+    spans = profiling.take_spans()
+    assert [x["stage"] for x in spans] == ["page", "get_rows"]
+    assert spans[1]["nmi"] == "NMI0000009"
+    assert spans[1]["rows"] == 3
+    if profiling.resource is not None:
+        assert all(x["peak_rss_growth_mb"] >= 0 for x in spans)
+
+    profiling.write_profile(spans, tmp_path)
+    assert (tmp_path / "profile.csv").read_text().count("NMI0000009") == 2
+    assert "get_rows" in profiling.format_summary(spans)
+
+
+def test_result_size():
+    assert profiling.result_size("abc") == {"bytes": 3}
+    assert profiling.result_size({"a": "ab", "b": "c"}) == {"bytes": 3}
+    assert profiling.result_size({"a": 1.0}) == {"rows": 1}
+    assert profiling.result_size(([1, 2], [3, 4])) == {"rows": 2}
+    assert profiling.result_size(None) == {}
@@ -0,0 +1,119 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from nemreport import report
+from nemreport.model import NMIData, connect, get_nmi_list, load_nmi_data
+from nemreport.prepare_db import update_nem_database
+
+
+@pytest.fixture(scope="module")
+def nmi():
+    connect(update_nem_database())
+    report.output_dir.mkdir(exist_ok=True)
+    return get_nmi_list()[0]
+
+
+def test_run_stages_only_needed(nmi):
+    ctx = report.run_stages(["month_table"], {"nmi": nmi, "keep_fragments": False})
+
+    assert "month_table" in ctx
+    assert "nmi_data" not in ctx  # Not a dependency of the month table
+
+
+def test_run_stages_skips_done(nmi):
+    ctx = {"nmi": nmi, "summary": None, "seasons": {"TOTAL": 1.0}}
+    report.run_stages(["seasons"], ctx, threads=1)
+
+    assert ctx["seasons"] == {"TOTAL": 1.0}
+
+
+def test_build_report_stages(nmi):
+    cache_file = report.stage_cache_path(nmi)
+    cache_file.unlink(missing_ok=True)
+    report.build_report(nmi)
+    assert not cache_file.exists()  # Only saved for builds with stages
+
+    report.build_report(nmi, stages=list(report.OUTPUT_STAGES))
+    cached = json.loads(cache_file.read_text())
+    assert set(cached["stages"]) == set(report.OUTPUT_STAGES)
+
+    cached["stages"]["daily"] = "<p>Cached daily chart</p>"
+    cache_file.write_text(json.dumps(cached))
+    html = report.build_report(nmi, stages=["heatmap"]).read_text(encoding="utf-8")
+    assert "Cached daily chart" in html
+
+    html = report.build_report(nmi, stages=["daily"]).read_text(encoding="utf-8")
+    assert "Cached daily chart" not in html
+
+
+def test_build_report_stale_stages(nmi):
+    report.build_report(nmi, stages=list(report.OUTPUT_STAGES))
+    cache_file = report.stage_cache_path(nmi)
+    cached = json.loads(cache_file.read_text())
+    cached["inputs"]["data"] = "changed"
+    cached["stages"]["daily"] = "<p>Stale daily chart</p>"
+    cache_file.write_text(json.dumps(cached))
+
+    html = report.build_report(nmi, stages=["heatmap"]).read_text(encoding="utf-8")
+    assert "Stale daily chart" not in html
+
+
+def test_chart_resolution():
+    assert report.chart_resolution(365, max_points=1000) == "day"
+    assert report.chart_resolution(3650, max_points=1000) == "week"
+    assert report.chart_resolution(3650, max_points=100) == "month"
+
+
+def test_resample_rows():
+    days = np.arange(np.datetime64("2024-01-01"), np.datetime64("2024-01-15"))
+    values = np.arange(14.0)[:, None] * np.ones((1, 2))
+    values[0, 0] = np.nan
+
+    starts, rows = report.resample_rows(days, values, "week")
+    assert list(starts.astype("datetime64[D]").astype(str)) == [
+        "2024-01-01",
+        "2024-01-08",
+    ]
+    assert rows[:, 0].tolist() == [3.5, 10.0]  # NaN cells are ignored
+    assert rows[:, 1].tolist() == [3.0, 10.0]
+
+
+def test_downsampled_charts(nmi):
+    nmi_data = load_nmi_data(nmi)
+    fig = report.daily_total_fig(nmi_data, max_points=20)
+    assert len(fig.data[0].x) <= 20
+
+    html = report.build_usage_heatmap(nmi_data, max_points=20)
+    assert f"{nmi}_usage_heatmap_" in html
+    assert list(report.output_dir.glob(f"{nmi}_usage_heatmap_*.html"))
+
+
+def test_downsampled_heatmap_with_gaps(nmi):
+    """20 days of data over 30 days is resampled on the 30 days it spans"""
+    t_start = np.arange(
+        np.datetime64("2024-01-01T00:00"),
+        np.datetime64("2024-01-31T00:00"),
+        np.timedelta64(30, "m"),
+    )
+    t_start = t_start[
+        (t_start < np.datetime64("2024-01-11"))
+        | (t_start >= np.datetime64("2024-01-21"))
+    ]
+    ones = np.ones(len(t_start))
+    days = np.unique(t_start.astype("datetime64[D]"))
+    nmi_data = NMIData("GAPS", t_start, ones, ones * 0, days, ones[:20], ones[:20])
+
+    html = report.build_usage_heatmap(nmi_data, max_points=25)
+    assert "GAPS_usage_heatmap_2024.html" in html
+
+
+def test_calendar_fig_weeks():
+    days = pd.date_range("2024-01-01", "2024-12-31")
+    fig = report.calendar_fig("TEST", pd.Series(1.0, index=days), "import")
+
+    cells = set(zip(fig.data[0].x.tolist(), fig.data[0].y.tolist(), strict=True))
+    assert len(cells) == len(days)  # No two days share a cell
+    assert fig.data[0].x[0] == 0 and fig.data[0].x[-1] == 52
@@ -0,0 +1,53 @@
+import threading
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+
+from nemreport import report
+from nemreport.prepare_db import DEFAULT_DIR
+from nemreport.server import make_server, try_update_database
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    report.configure(DEFAULT_DIR, Path("output"))
+    server = make_server("127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+    server.server_close()
+
+
+def test_serve_index(server_url, first_nmi):
+    with urlopen(server_url) as resp:
+        assert f"{first_nmi}.html" in resp.read().decode()
+
+
+def test_serve_report(server_url, first_nmi):
+    page = report.output_dir / f"{first_nmi}.html"
+    page.unlink(missing_ok=True)
+    with urlopen(server_url + f"{first_nmi}.html") as resp:
+        assert "Tariff Calculator" in resp.read().decode()
+    modified = page.stat().st_mtime_ns
+
+    with urlopen(server_url + f"{first_nmi}.html") as resp:
+        assert resp.status == 200
+    assert page.stat().st_mtime_ns == modified  # Served from the cache
+
+
+def test_serve_portfolio(server_url):
+    with urlopen(server_url + "portfolio.html") as resp:
+        assert "Coincident peak" in resp.read().decode()
+
+
+def test_serve_unknown_nmi(server_url):
+    with pytest.raises(HTTPError) as e:
+        urlopen(server_url + "NOTANMI.html")
+    assert e.value.code == 404
+
+
+def test_update_database_failure(tmp_path, caplog):
+    try_update_database(tmp_path)
+    assert "Unable to update the database" in caplog.text
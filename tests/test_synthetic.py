@@ -0,0 +1,42 @@
+from datetime import date
+
+import pytest
+from nemreader import NEMFile
+
+from nemreport.synthetic import generate_nem12_files, write_nem12
+
+
+def test_write_nem12(tmp_path):
+    file_path = write_nem12(
+        tmp_path / "test.csv", "NMI0000009", date(2024, 1, 1), 60, interval=15
+    )
+    m = NEMFile(file_path, strict=True).nem_data()
+    reads = m.readings["NMI0000009"]
+    assert set(reads) == {"E1", "B1"}
+    assert len(reads["E1"]) == 60 * 96
+    assert min(x.read_value for x in reads["B1"]) == 0.0
+    assert max(x.read_value for x in reads["B1"]) > 0.0
+
+
+def test_write_nem12_gaps(tmp_path):
+    file_path = write_nem12(
+        tmp_path / "test.csv",
+        "NMI0000009",
+        date(2024, 1, 1),
+        100,
+        export=False,
+        gap_fraction=0.2,
+    )
+    reads = NEMFile(file_path).nem_data().readings["NMI0000009"]
+    assert set(reads) == {"E1"}
+    assert 60 * 48 <= len(reads["E1"]) <= 80 * 48
+
+
+def test_write_nem12_bad_interval(tmp_path):
+    with pytest.raises(ValueError):
+        write_nem12(tmp_path / "test.csv", "NMI0000009", date(2024, 1, 1), 1, 10)
+
+
+def test_generate_nem12_files(tmp_path):
+    files = generate_nem12_files(tmp_path, num_nmis=3, years=0.1, interval=5)
+    assert [x.name for x in files] == [f"SYN000000{i}.csv" for i in (1, 2, 3)]
@@ -0,0 +1,213 @@
+import json
+import sys
+
+import numpy as np
+import pytest
+from pydantic import ValidationError
+from typer.testing import CliRunner
+
+from nemreport import profiling, report
+from nemreport.cli import app
+from nemreport.model import NMIData, get_nmi_list, load_nmi_data
+from nemreport.prepare_db import DEFAULT_DIR, update_nem_database
+from nemreport.tariffs import (
+    Tariff,
+    TariffEngine,
+    UsageGrid,
+    find_tariff_file,
+    load_tariffs,
+    tariff_file_hash,
+)
+
+TARIFFS = [
+    {"name": "Flat", "daily_charge": 1.0, "rate": 0.3, "feed_in": 0.05},
+    {
+        "name": "Time of use",
+        "daily_charge": 1.2,
+        "rate": 0.25,
+        "windows": [
+            {"name": "Peak", "rate": 0.5, "start": "16:00", "end": "21:00"},
+            {"name": "Off peak", "rate": 0.1, "start": "22:00", "end": "07:00"},
+        ],
+    },
+    {
+        "name": "Demand",
+        "rate": 0.2,
+        "demand": [{"rate": 10, "start": "16:00", "end": "21:00", "days": "weekday"}],
+    },
+]
+
+
+@pytest.fixture
+def fortnight() -> NMIData:
+    """1 kWh every 5 minutes (12 kW) for two weeks from a Monday"""
+    t_start = np.arange(
+        np.datetime64("2024-01-01T00:00"),
+        np.datetime64("2024-01-15T00:00"),
+        np.timedelta64(5, "m"),
+    )
+    ones = np.ones(len(t_start))
+    days = np.arange(np.datetime64("2024-01-01"), np.datetime64("2024-01-15"))
+    return NMIData("TEST", t_start, ones, ones * 0.5, days, ones[:14], ones[:14])
+
+
+def test_bill_flat(fortnight):
+    usage = UsageGrid.from_nmi_data(fortnight)
+    bill = TariffEngine([Tariff(**TARIFFS[0])]).bill(Tariff(**TARIFFS[0]), usage)
+
+    assert bill["days"] == 14
+    assert bill["supply"] == 14.0
+    assert bill["energy"] == pytest.approx(14 * 288 * 0.3)
+    assert bill["feed_in"] == pytest.approx(14 * 288 * 0.5 * 0.05)
+
+
+def test_bill_time_of_use(fortnight):
+    usage = UsageGrid.from_nmi_data(fortnight)
+    tariff = Tariff(**TARIFFS[1])
+    bill = TariffEngine([tariff]).bill(tariff, usage)
+
+    # 5 h peak, 9 h off peak past midnight and 10 h at the flat rate each day
+    expected = 14 * 12 * (5 * 0.5 + 9 * 0.1 + 10 * 0.25)
+    assert bill["energy"] == pytest.approx(expected)
+
+
+def test_bill_demand(fortnight):
+    usage = UsageGrid.from_nmi_data(fortnight)
+    tariff = Tariff(**TARIFFS[2])
+    bill = TariffEngine([tariff]).bill(tariff, usage)
+
+    assert bill["demand"] == pytest.approx(12 * 10)  # One month at 12 kW
+
+
+def test_rank(fortnight):
+    tariffs = [Tariff(**x) for x in TARIFFS]
+    ranking = TariffEngine(tariffs).rank(UsageGrid.from_nmi_data(fortnight))
+
+    assert [x["rank"] for x in ranking] == [1, 2, 3]
+    assert ranking[0]["annual"] <= ranking[-1]["annual"]
+    assert ranking[1]["saving"] == 0
+    assert ranking[0]["saving"] > 0 > ranking[-1]["saving"]
+    assert {x["saving_vs"] for x in ranking} == {"median"}
+
+    tariffs[0].current = True
+    ranking = TariffEngine(tariffs).rank(UsageGrid.from_nmi_data(fortnight))
+    assert {x["saving_vs"] for x in ranking} == {"Flat"}
+    assert next(x["saving"] for x in ranking if x["tariff"] == "Flat") == 0
+
+
+def test_tariff_needs_rate():
+    with pytest.raises(ValueError):
+        Tariff(name="No rates", daily_charge=1.0)
+    with pytest.raises(ValueError):
+        Tariff(name="Bad window", windows=[{"rate": 0.1, "start": "25:00"}])
+    for month in (0, 13):
+        with pytest.raises(ValidationError):
+            Tariff(name="Bad month", rate=0.2, demand=[{"rate": 1, "months": [month]}])
+    with pytest.raises(ValueError):
+        Tariff(name="Gaps", windows=[{"rate": 0.5, "start": "16:00", "end": "21:00"}])
+    windows = [{"rate": 0.5, "start": "07:00", "end": "22:00"}, {"rate": 0.1}]
+    assert Tariff(name="Covered", windows=windows).rate is None
+
+
+def test_load_tariffs(tmp_path):
+    pytest.importorskip("yaml")
+    json_file = tmp_path / "tariffs.json"
+    json_file.write_text(json.dumps({"tariffs": TARIFFS}))
+    yaml_file = tmp_path / "tariffs.yaml"
+    yaml_file.write_text("- name: Flat\n  rate: 0.3\n")
+
+    names = [x.name for x in load_tariffs(json_file)]
+    assert names == ["Flat", "Time of use", "Demand"]
+    assert load_tariffs(yaml_file)[0].rate == 0.3
+    assert find_tariff_file(tmp_path) == json_file
+
+
+def test_load_tariffs_without_yaml(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "yaml", None)
+    yaml_file = tmp_path / "tariffs.yaml"
+    yaml_file.write_text("- name: Flat\n  rate: 0.3\n")
+    with pytest.raises(ImportError, match=r"nemreport\[yaml\]"):
+        load_tariffs(yaml_file)
+
+
+def test_load_tariffs_one_current(tmp_path):
+    json_file = tmp_path / "tariffs.json"
+    json_file.write_text(json.dumps([{**x, "current": True} for x in TARIFFS]))
+    with pytest.raises(ValueError, match="Only one tariff"):
+        load_tariffs(json_file)
+
+
+@pytest.fixture
+def tariff_file():
+    file_path = DEFAULT_DIR / "tariffs.json"
+    file_path.write_text(json.dumps(TARIFFS))
+    yield file_path
+    file_path.unlink()
+
+
+def test_cli_tariffs(tariff_file):
+    update_nem_database(DEFAULT_DIR)
+    result = CliRunner().invoke(app, ["tariffs", "--top", "2", "--format", "json"])
+
+    assert result.exit_code == 0
+    rows = json.loads(result.stdout)
+    assert len(rows) == 2 * len(get_nmi_list())
+    assert {x["rank"] for x in rows} == {1, 2}
+
+    result = CliRunner().invoke(app, ["tariffs", "--top", "1"])
+    assert "saving vs median" in result.stdout
+
+
+def test_cli_tariffs_no_file(tmp_path):
+    result = CliRunner().invoke(app, ["--data-dir", str(tmp_path), "tariffs"])
+
+    assert result.exit_code == 1
+
+
+def test_report_tariff_ranking(tariff_file):
+    update_nem_database(DEFAULT_DIR)
+    report.output_dir.mkdir(exist_ok=True)
+    nmi = get_nmi_list()[0]
+
+    nmi_data = load_nmi_data(nmi)
+    profiling.enable()
+    try:
+        ranking = report.get_tariff_ranking(nmi_data, report.get_tariffs())
+        assert len(ranking) == len(TARIFFS)
+    finally:
+        profiling.enable(False)
+    assert [x["stage"] for x in profiling.take_spans()] == ["get_tariff_ranking"]
+    html = report.build_report(nmi).read_text(encoding="utf-8")
+    assert "Tariff Comparison" in html
+
+
+def test_build_reads_tariffs_once(tariff_file, monkeypatch):
+    hashed, loaded = [], []
+
+    def counted_hash(file_path):
+        hashed.append(file_path)
+        return tariff_file_hash(file_path)
+
+    def counted_load(file_path):
+        loaded.append(file_path)
+        return load_tariffs(file_path)
+
+    monkeypatch.setattr(report, "tariff_file_hash", counted_hash)
+    monkeypatch.setattr(report, "load_tariffs", counted_load)
+    result = CliRunner().invoke(app, ["build", "--force"])
+
+    assert result.exit_code == 0
+    assert hashed == [tariff_file]
+    assert loaded == [tariff_file]
+
+
+def test_build_invalid_tariffs(tariff_file, caplog):
+    gaps = {"name": "Gaps", "windows": [{"rate": 0.5, "start": "16:00"}]}
+    tariff_file.write_text(json.dumps([gaps]))
+    update_nem_database(DEFAULT_DIR)
+    report.output_dir.mkdir(exist_ok=True)
+    nmi = get_nmi_list()[0]
+
+    html = report.build_report(nmi).read_text(encoding="utf-8")
+    assert "Tariff Comparison" not in html
+    assert "Skipping tariff comparison" in caplog.text